@@ -1,9 +1,57 @@
 import ee
 import os
+import re
 import csv
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-def copy(source, destination):
+import retrying
+
+from .journal import CopyJournal
+from .listing import CONTAINER_TYPES, walk
+from .tasks import retry_if_ee_error
+from .throughput import AssetProgress
+
+# Earth Engine refuses to overwrite an asset with a message such as "Cannot overwrite asset ...", or "... already
+# exists" when creating one.
+ALREADY_EXISTS_RE = re.compile(r'already exists|cannot overwrite', re.IGNORECASE)
+
+
+def copy(source, destination, workers=10, journal_path='copy_journal.sqlite', resume=False):
+    """
+    Copies assets concurrently. If source is a CSV file with lines [asset name],[asset id in GME], the GME images
+    are copied into destination. Otherwise source is an Earth Engine asset, which is copied to destination with
+    everything inside it: folders and collections are created in the same order as in the source, and images and
+    tables are copied into them.
+
+    Every finished asset is recorded in a journal; failures are appended to failed_batch_copy.csv.
+
+    :param source: CSV file, or full path to an image, a table, a folder or a collection
+    :param destination: folder or collection for GME images; otherwise full path of the copy
+    :param workers: (optional) number of assets copied at the same time
+    :param journal_path: (optional) SQLite file recording finished assets
+    :param resume: (optional) skip the assets the journal records as copied
+    :return: number of assets that could not be copied
+    """
+    journal = CopyJournal(journal_path)
+    failures = FailedCopiesWriter()
+    progress = AssetProgress('Copied')
+    try:
+        if os.path.isfile(source):
+            pairs = _gme_pairs(source, destination)
+        else:
+            pairs = _ee_pairs(source, destination, workers, journal, resume, failures, progress)
+        _copy_all(pairs, workers, journal, resume, failures, progress)
+    finally:
+        journal.close()
+        failures.close()
+    progress.log()
+    if progress.failed:
+        logging.error('%d assets could not be copied. See failed_batch_copy.csv', progress.failed)
+    return progress.failed
+
+
+def _gme_pairs(source, destination):
     with open(source, 'r') as f:
         reader = csv.reader(f)
         for line in reader:
@@ -11,16 +59,153 @@ def copy(source, destination):
             gme_id = line[1]
             gme_path = 'GME/images/' + gme_id
             ee_path = os.path.join(destination, name)
-            logging.info('Copying asset %s to %s', gme_path, ee_path)
-            try:
-                ee.data.copyAsset(gme_path, ee_path)
-            except ee.EEException as e:
-                with open('failed_batch_copy.csv', 'w') as fout:
-                    fout.write('{},{},{},{}'.format(name, gme_id, ee_path,e))
+            yield gme_path, ee_path
+
+
+def _ee_pairs(source, destination, workers, journal, resume, failures, progress):
+    """
+    Yields (source, destination) of every image and table to copy. Containers are created on the way, by the
+    calling thread, so a container always exists before anything is copied into it.
+    """
+    info = ee.data.getInfo(source)
+    if not info:
+        logging.error('%s does not exist', source)
+        journal.failed(source, destination, 'Source does not exist')
+        failures.writerow([source, destination, 'Source does not exist'])
+        progress.update(False)
+        return
+    if info['type'] not in CONTAINER_TYPES:
+        yield source, destination
+        return
+
+    if not _create_container(source, destination, info['type'], journal, resume, failures, progress):
+        return
+    # Destinations of containers that could not be created; nothing is copied below them.
+    missing = set()
+
+    def on_error(container, error):
+        container_destination = destination + container[len(source):]
+        logging.error('Failed to list %s: %s', container, error)
+        journal.failed(container, container_destination, str(error))
+        failures.writerow([container, container_destination, error])
+        progress.update(False)
+
+    for asset in walk([source], workers=workers, descend=CONTAINER_TYPES, on_error=on_error):
+        asset_destination = destination + asset['id'][len(source):]
+        parent = asset_destination.rsplit('/', 1)[0]
+        if parent in missing:
+            missing.add(asset_destination)
+            continue
+        if asset['type'] in CONTAINER_TYPES:
+            if not _create_container(asset['id'], asset_destination, asset['type'], journal, resume, failures,
+                                     progress):
+                missing.add(asset_destination)
+        else:
+            yield asset['id'], asset_destination
+
+
+def _create_container(source, destination, asset_type, journal, resume, failures, progress):
+    if resume and journal.is_copied(source, destination):
+        return True
+    try:
+        _create_asset(asset_type, destination)
+    except ee.EEException as e:
+        # Copying into an existing folder or collection is fine: clashing images and tables still fail.
+        if not ALREADY_EXISTS_RE.search(str(e)):
+            logging.error('Failed to create %s: %s', destination, e)
+            journal.failed(source, destination, str(e))
+            failures.writerow([source, destination, e])
+            progress.update(False)
+            return False
+    logging.info('Created %s', destination)
+    journal.copied(source, destination)
+    progress.update(True)
+    return True
+
+
+def _copy_all(pairs, workers, journal, resume, failures, progress):
+    def handle(future, source, destination):
+        try:
+            future.result()
+        except ee.EEException as e:
+            logging.error('Failed to copy %s to %s: %s', source, destination, e)
+            journal.failed(source, destination, str(e))
+            failures.writerow([source, destination, e])
+            progress.update(False)
+            return
+        journal.copied(source, destination)
+        progress.update(True)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {}
+        for source, destination in pairs:
+            if resume and journal.is_copied(source, destination):
+                progress.skipped += 1
+                continue
+            future = pool.submit(_copy_asset, source, destination)
+            pending[future] = (source, destination)
+            # Keep a bounded number of copies queued, so the source tree is read while copying.
+            if len(pending) >= 4 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    handle(future, *pending.pop(future))
+        for future in list(pending):
+            handle(future, *pending.pop(future))
+
+
+def _copy_asset(source, destination):
+    attempts = []
+
+    def attempt():
+        attempts.append(source)
+        try:
+            ee.data.copyAsset(source, destination)
+        except ee.EEException as e:
+            # An attempt that failed with a transient error may still have made the copy. An asset that existed
+            # before the first attempt is somebody else's, and a failure.
+            if len(attempts) == 1 or not ALREADY_EXISTS_RE.search(str(e)):
+                raise
+            logging.debug('%s was copied by an earlier attempt', destination)
+
+    _call_with_retry(attempt)
+
+
+def _is_retryable(exception):
+    return retry_if_ee_error(exception) and not ALREADY_EXISTS_RE.search(str(exception))
+
+
+@retrying.retry(retry_on_exception=_is_retryable, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _call_with_retry(function):
+    return function()
+
+
+@retrying.retry(retry_on_exception=_is_retryable, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _create_asset(asset_type, destination):
+    ee.data.createAsset({'type': asset_type}, destination)
+
+
+class FailedCopiesWriter(object):
+
+    def __init__(self, filename='failed_batch_copy.csv'):
+        """Appends failed copies to a CSV file, which is only opened once something fails."""
+        self.filename = filename
+        self.fout = None
+
+    def writerow(self, row):
+        if self.fout is None:
+            self.fout = open(self.filename, 'a')
+            self.writer = csv.writer(self.fout)
+        self.writer.writerow(row)
+        self.fout.flush()
+
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
 
 
 if __name__ == '__main__':
     ee.Initialize()
     assets = '/home/tracek/Data/consbio2016/test.csv'
     with open(assets, 'r') as f:
-        reader = csv.reader(f)
\ No newline at end of file
+        reader = csv.reader(f)
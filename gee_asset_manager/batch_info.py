@@ -4,82 +4,403 @@
 import sys
 import datetime
 import csv
+import collections
+import heapq
+import itertools
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import ee
+import retrying
+
+from .listing import CONTAINER_TYPES, walk
+from .snapshot import ReportSnapshot
+from .tasks import retry_if_ee_error
+
+
+REPORT_HEADER = ['Asset id', 'Type', 'Size [MB]', 'Time', 'Owners', 'Readers', 'Writers']
+FIELD_NAMES = ['asset_id', 'type', 'size_mb', 'time', 'owners', 'readers', 'writers']
+OUTPUT_FORMATS = ('csv', 'jsonl', 'parquet')
 
 
 class ReportWriter(object):
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, output_format='csv', top=10):
+        """
+        Writes report rows as CSV to stdout and, if a file name is given, to a file in the chosen format. Sizes are
+        in MB.
+        :param filename: (optional) name of the output file, without extension
+        :param output_format: (optional) one of OUTPUT_FORMATS; parquet needs pyarrow
+        :param top: (optional) number of largest folders and collections printed when the report is closed
+        """
         self.total_size = 0
-        self.writers = [csv.writer(sys.stdout)]
+        self.top = top
+        self.largest = []
+        # Nothing is printed on close until the output is open.
+        self.closed = True
         self.writer_fo = None
-        if filename:
-            if sys.version_info[0] < 3:
-                self.writer_fo = open(filename + '.csv', 'wb')
-            else:
-                self.writer_fo = open(filename + '.csv', 'w')
+        self.writers = []
+        if filename and output_format == 'parquet':
+            self.writer_fo = ParquetWriter(filename + '.parquet')
+            self.writers.append(self.writer_fo)
+        elif filename and output_format == 'jsonl':
+            self.writer_fo = open(filename + '.jsonl', 'w')
+            self.writers.append(JsonLinesWriter(self.writer_fo))
+        elif filename:
+            self.writer_fo = open(filename + '.csv', 'w')
             self.writers.append(csv.writer(self.writer_fo))
+            self.writers[-1].writerow(REPORT_HEADER)
+        self.writers.append(csv.writer(sys.stdout))
+        self.writers[-1].writerow(REPORT_HEADER)
+        self.closed = False
 
     def __del__(self):
-        if self.writer_fo and not self.writer_fo.closed:
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer_fo:
             self.writer_fo.close()
+        if self.largest:
+            print('Largest folders and collections [MB]:')
+            for size, asset_id in sorted(self.largest, reverse=True):
+                print('{:12.2f}  {}'.format(size, asset_id))
         print('Total size [MB]: {:.2f}'.format(self.total_size))
 
     def writerow(self, data):
+        asset_type, size = data[1], data[2]
+        if size != '':
+            data = data[:2] + [round(size, 2)] + data[3:]
+            if asset_type == ee.data.ASSET_TYPE_IMAGE_COLL or asset_type not in CONTAINER_TYPES:
+                # Folder sizes are sums of the assets inside, which are counted already.
+                self.total_size += size
+            if asset_type in CONTAINER_TYPES and self.top:
+                if len(self.largest) < self.top:
+                    heapq.heappush(self.largest, (size, data[0]))
+                else:
+                    heapq.heappushpop(self.largest, (size, data[0]))
         [writer.writerow(data) for writer in self.writers]
 
-def report(filename):
+
+class JsonLinesWriter(object):
+
+    def __init__(self, fo):
+        self.fo = fo
+
+    def writerow(self, data):
+        row = dict(zip(FIELD_NAMES, data))
+        if row['size_mb'] == '':
+            row['size_mb'] = None
+        self.fo.write(json.dumps(row) + '\n')
+
+
+class ParquetWriter(object):
+
+    def __init__(self, filename, batch_size=10000):
+        """
+        Writes report rows to a Parquet file in row groups of batch_size rows.
+        :param filename: path to the file; overwritten
+        :param batch_size: (optional) number of rows kept in memory before they are written
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logging.error('Parquet output needs pyarrow. Install it with: pip install pyarrow')
+            sys.exit(1)
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(name, pyarrow.float64() if name == 'size_mb' else pyarrow.string())
+                                      for name in FIELD_NAMES])
+        self.writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def writerow(self, data):
+        self.rows.append(data)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = {name: [None if row[2] == '' and name == 'size_mb' else row[i] for row in self.rows]
+                   for i, name in enumerate(FIELD_NAMES)}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class SizeRollup(object):
+
+    def __init__(self, on_complete):
+        """
+        Sums the sizes of assets into the folders containing them, in a single pass over the crawled tree. A folder
+        is complete once it has been described, listed and every asset inside it has been added; its total then goes
+        up to its own parent. Only folders still open are kept in memory.
+        :param on_complete: called with (row, context) of a folder once its total is known; the size in the row is
+        replaced by the total in MB
+        """
+        self.on_complete = on_complete
+        self.folders = {}
+
+    def root(self, folder_id):
+        """Registers a folder that has no row of its own."""
+        self._folder(folder_id)['described'] = True
+
+    def folder(self, folder_id, row, context=None):
+        """Registers the row of a folder; row is None if it could not be described."""
+        folder = self._folder(folder_id)
+        folder.update(row=row, context=context, described=True)
+        self._check(folder_id)
+
+    def listed(self, folder_id, children):
+        folder = self._folder(folder_id)
+        folder['listed'] = True
+        folder['pending'] += len(children)
+        self._check(folder_id)
+
+    def add(self, asset_id, size):
+        """Adds the size in MB of an asset to its folder."""
+        folder_id = asset_id.rsplit('/', 1)[0]
+        folder = self.folders.get(folder_id)
+        if folder is None:
+            return
+        folder['size'] += size or 0
+        folder['pending'] -= 1
+        self._check(folder_id)
+
+    def _folder(self, folder_id):
+        if folder_id not in self.folders:
+            self.folders[folder_id] = {'row': None, 'context': None, 'described': False, 'listed': False,
+                                       'pending': 0, 'size': 0.0}
+        return self.folders[folder_id]
+
+    def _check(self, folder_id):
+        folder = self.folders[folder_id]
+        if not (folder['described'] and folder['listed'] and folder['pending'] == 0):
+            return
+        del self.folders[folder_id]
+        if folder['row'] is not None:
+            row = folder['row']
+            self.on_complete(row[:2] + [folder['size']] + row[3:], folder['context'])
+        self.add(folder_id, folder['size'])
+
+
+def report(filename, workers=10, acl=True, snapshot_path=None, diff_path=None, output_format='csv', top=10,
+           size_batch=50):
+    """
+    Writes a row for every asset in the asset roots of the user. Folders are walked to the bottom, while image
+    collections are reported as a whole. Listing, info and ACL requests run on workers threads, and rows are written
+    in the order their requests complete. The size of a folder is the total of everything inside it, so its row comes
+    after the rows of its content.
+
+    With a snapshot only assets whose listed version changed since the previous run are queried again; the others
+    are reported from the snapshot. Image collections are always sized again, as adding images does not change their
+    version. Their sizes are summed by Earth Engine, for size_batch collections in a single request.
+    :param filename: (optional) name of the output file, without extension; rows are always printed to stdout
+    :param workers: (optional) number of concurrent requests
+    :param acl: (optional) fetch owners, readers and writers of every asset; skipping them halves the requests
+    :param snapshot_path: (optional) SQLite file with the previous report; created if it does not exist
+    :param diff_path: (optional) CSV file listing assets added, changed and deleted since the previous run
+    :param output_format: (optional) format of the output file: csv, jsonl or parquet
+    :param top: (optional) number of largest folders and collections listed at the end
+    :param size_batch: (optional) number of collections sized in one request
+    """
     ee.Initialize()
     assets_root = ee.data.getAssetRoots()
-    writer = ReportWriter(filename)
-    writer.writerow(['Asset id', 'Type', 'Size [MB]', 'Time', 'Owners', 'Readers', 'Writers'])
+    writer = ReportWriter(filename, output_format=output_format, top=top)
 
-    for asset in assets_root:
-        # List size+name for every leaf asset, and show totals for non-leaves.
+    snapshot = ReportSnapshot(snapshot_path) if snapshot_path else None
+    run = snapshot.begin() if snapshot else None
+    changes = ChangeWriter(diff_path) if diff_path else None
+
+    def emit(row, version, previous):
+        writer.writerow(row)
+        if snapshot:
+            snapshot.put(version, row, run)
+        if changes and not previous:
+            changes.writerow(ChangeWriter.ADDED, row)
+        elif changes and not _same_row(previous.row, row):
+            changes.writerow(ChangeWriter.CHANGED, row)
+
+    rollup = SizeRollup(on_complete=lambda row, context: emit(row, *context))
+
+    # Requests in flight, each mapped to the function handling its result and the arguments of that function.
+    pending = {}
+    # Rows of collections waiting for their size, which is asked for in batches.
+    unsized = []
+
+    def handle(future, asset, version, previous):
+        try:
+            row = future.result()
+        except ee.EEException as e:
+            logging.warning('Asset skipped: %s', e)
+            if previous:
+                # Not knowing the current state is no reason to report it as deleted.
+                snapshot.seen(previous.asset_id, run)
+            if asset['type'] == ee.data.ASSET_TYPE_FOLDER:
+                rollup.folder(asset['id'], None)
+            else:
+                rollup.add(asset['id'], 0)
+            return
         if asset['type'] == ee.data.ASSET_TYPE_FOLDER:
-            children = ee.data.getList(asset)
-            for child in children:
-                _print_size(child, writer)
+            rollup.folder(asset['id'], row, (version, previous))
+        elif asset['type'] == ee.data.ASSET_TYPE_IMAGE_COLL:
+            add_unsized(row, version, previous)
         else:
-            _print_size(asset, writer)
+            emit(row, version, previous)
+            rollup.add(asset['id'], row[2])
+
+    def add_unsized(row, version, previous):
+        unsized.append((row, version, previous))
+        if len(unsized) >= size_batch:
+            request_sizes()
+
+    def request_sizes(batch=None):
+        if batch is None:
+            batch = unsized[:]
+            del unsized[:]
+        future = pool.submit(_get_collection_sizes, [row[0] for row, _, _ in batch])
+        pending[future] = (handle_sizes, batch)
+
+    def handle_sizes(future, batch):
+        try:
+            sizes = future.result()
+        except ee.EEException as e:
+            if len(batch) > 1:
+                # A single collection that cannot be read fails the whole request: ask for each one on its own.
+                for item in batch:
+                    request_sizes([item])
+                return
+            logging.warning('Size of %s is unknown: %s', batch[0][0][0], e)
+            sizes = {}
+        for row, version, previous in batch:
+            size = sizes.get(row[0])
+            row = row[:2] + [size / 1024**2 if size is not None else ''] + row[3:] # size in MB
+            emit(row, version, previous)
+            rollup.add(row[0], row[2])
+
+    def handle_done():
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            handler, *args = pending.pop(future)
+            handler(future, *args)
+
+    folders = [asset['id'] for asset in assets_root if asset['type'] == ee.data.ASSET_TYPE_FOLDER]
+    others = [asset for asset in assets_root if asset['type'] != ee.data.ASSET_TYPE_FOLDER]
+    for folder_id in folders:
+        rollup.root(folder_id)
+    assets = itertools.chain(others, walk(folders, workers=workers, on_listed=rollup.listed))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for asset in assets:
+                version = asset.get('updateTime') or asset.get('version')
+                previous = snapshot.get(asset['id']) if snapshot else None
+                if previous and version is not None and previous.version == str(version):
+                    if asset['type'] == ee.data.ASSET_TYPE_FOLDER:
+                        # The total is computed again from the content.
+                        rollup.folder(asset['id'], previous.row, (version, previous))
+                        continue
+                    elif asset['type'] == ee.data.ASSET_TYPE_IMAGE_COLL:
+                        add_unsized(previous.row, version, previous)
+                    else:
+                        snapshot.seen(asset['id'], run)
+                        writer.writerow(previous.row)
+                        rollup.add(asset['id'], previous.row[2])
+                    continue
+                future = pool.submit(_describe, asset, acl)
+                pending[future] = (handle, asset, version, previous)
+                # Keep a bounded number of requests in flight, so rows are written while the walk goes on.
+                if len(pending) >= 4 * workers:
+                    handle_done()
+            while pending or unsized:
+                if unsized:
+                    request_sizes()
+                handle_done()
+
+        if snapshot:
+            deleted = snapshot.remove_unseen(run)
+            if changes:
+                for row in deleted:
+                    changes.writerow(ChangeWriter.DELETED, row)
+    finally:
+        writer.close()
+        if snapshot:
+            snapshot.close()
+        if changes:
+            changes.close()
+
+
+def _same_row(previous, row):
+    # Totals are sums of floats, which may come out slightly different in another order.
+    rounded = lambda r: r[:2] + [round(r[2], 2) if r[2] != '' else ''] + r[3:]
+    return rounded(previous) == rounded(row)
+
+
+class ChangeWriter(object):
+
+    ADDED = 'added'
+    CHANGED = 'changed'
+    DELETED = 'deleted'
+
+    def __init__(self, filename):
+        """
+        CSV file with the report rows of assets that differ from the previous run, each preceded by the kind of change.
+        :param filename: path to the file; overwritten
+        """
+        self.counts = collections.Counter()
+        self.writer_fo = open(filename, 'w')
+        self.writer = csv.writer(self.writer_fo)
+        self.writer.writerow(['Change'] + REPORT_HEADER)
+
+    def writerow(self, change, row):
+        self.counts[change] += 1
+        if row[2] != '':
+            row = row[:2] + [round(row[2], 2)] + row[3:]
+        self.writer.writerow([change] + row)
+
+    def close(self):
+        self.writer_fo.close()
+        logging.info('Since the previous report %d assets were added, %d changed and %d deleted',
+                     self.counts[self.ADDED], self.counts[self.CHANGED], self.counts[self.DELETED])
 
 def get_datetime_str(epoch):
     dt = datetime.datetime.fromtimestamp(epoch / 10**6) # microseconds to seconds
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
-def _print_size(asset, writer):
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _describe(asset, acl=True):
+    """
+    Returns the report row of an asset. The size of folders and collections is left empty: it is the total of their
+    content.
+    """
     asset_info = ee.data.getInfo(asset['id'])
 
-    if 'properties' in asset_info and 'system:asset_size' in asset_info['properties']:
-        size = asset_info['properties']['system:asset_size']
+    if asset_info['type'] in CONTAINER_TYPES:
+        size = None
     else:
-        size = _get_size(asset)
-    size = round(size / 1024**2, 2) # size in MB
+        size = asset_info.get('properties', {}).get('system:asset_size')
+    size = size / 1024**2 if size is not None else '' # size in MB
 
     type = asset_info['type']
     time = get_datetime_str(asset_info['version'])
 
-    acl = ee.data.getAssetAcl(asset['id'])
-    owners = ' '.join(acl['owners'])
-    readers = ' '.join(acl['readers'])
-    writers = ' '.join(acl['writers'])
-
-    writer.writerow([asset['id'], type, size, time, owners, readers, writers])
-    writer.total_size += size
-
-
-def _get_size(asset):
-    """Returns the size of the given asset in bytes."""
-    size_parsers = {
-        'Folder': _get_size_folder,
-        'ImageCollection': _get_size_image_collection,
-    }
-
-    if asset['type'] not in size_parsers:
-        raise ee.EEException(
-            'Cannot get size for asset type "%s"' % asset['type'])
+    if acl:
+        acl = ee.data.getAssetAcl(asset['id'])
+        owners = ' '.join(acl['owners'])
+        readers = ' '.join(acl['readers'])
+        writers = ' '.join(acl['writers'])
+    else:
+        owners = readers = writers = ''
 
-    return size_parsers[asset['type']](asset)
+    return [asset['id'], type, size, time, owners, readers, writers]
 
 
 def _get_size_image(asset):
@@ -88,18 +409,15 @@ def _get_size_image(asset):
     return info['properties']['system:asset_size']
 
 
-def _get_size_folder(asset):
-    children = ee.data.getList(asset)
-    sizes = [_get_size(child) for child in children]
-
-    return sum(sizes)
-
-
-def _get_size_image_collection(asset):
-    images = ee.ImageCollection(asset['id'])
-    sizes = images.aggregate_array('system:asset_size')
-
-    return sum(sizes.getInfo())
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _get_collection_sizes(collection_ids):
+    """
+    Returns the sizes in bytes of image collections, keyed by id. The sizes of the images are summed by Earth Engine
+    and all collections are combined into a single request, so only the totals are downloaded.
+    """
+    sizes = ee.Dictionary({collection_id: ee.ImageCollection(collection_id).aggregate_sum('system:asset_size')
+                           for collection_id in collection_ids})
+    return sizes.getInfo()
 
 
 if __name__ == '__main__':
@@ -18,43 +18,124 @@ __copyright__ = """
 __license__ = "Apache 2.0"
 
 import fnmatch
+import itertools
 import logging
+import re
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import ee
+import retrying
 
+from .listing import CONTAINER_TYPES, iter_children, list_children
+from .tasks import retry_if_ee_error
+from .throughput import AssetProgress
 
-def delete(asset_path):
+# Earth Engine reports deleting a missing asset with messages such as "Asset ... not found" or "... does not exist".
+NOT_FOUND_RE = re.compile(r'not found|does not exist', re.IGNORECASE)
+
+
+def delete(asset_path, workers=10, chunk_size=1000):
+    """
+    Deletes the assets matching a path with Unix-like wildcards, together with everything inside them. The trees are
+    listed once, level by level, and then deleted bottom up: all assets of a level are removed concurrently before
+    moving to the level above, so a folder or a collection is only deleted once it is empty. Assets that are already
+    gone count as deleted. If an asset cannot be deleted, its ancestors are kept.
+    :param asset_path: full path, e.g. users/pinkiepie/rainbow or users/pinkiepie/*weird*
+    :param workers: (optional) number of concurrent requests
+    :param chunk_size: (optional) number of deletions queued on the pool at once
+    :return: number of assets that could not be deleted
+    """
     root_idx = asset_path.rfind('/')
     if root_idx == -1:
         logging.warning('Asset not found. Make sure you pass full asset name, e.g. users/pinkiepie/rainbow')
         sys.exit(1)
     root = asset_path[:root_idx]
-    all_assets_names = [e['id'] for e in ee.data.getList({'id': root})]
-    filtered_names = fnmatch.filter(all_assets_names, asset_path)
-    if not filtered_names:
+    filtered_assets = [asset for asset in iter_children(root) if fnmatch.fnmatch(asset['id'], asset_path)]
+    if not filtered_assets:
         logging.warning('Nothing to remove. Exiting.')
         sys.exit(1)
-    else:
-        for path in filtered_names:
-            __delete_recursive(path)
-            logging.info('Collection %s removed', path)
 
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        levels = __list_tree(pool, filtered_assets)
+        total = sum(len(level) for level in levels)
+        logging.info('Found %d assets to delete in %d levels', total, len(levels))
 
-def __delete_recursive(asset_path):
-    info = ee.data.getInfo(asset_path)
-    if not info:
-        logging.warning('Nothing to delete.')
-        sys.exit(1)
-    elif info['type'] == 'Image':
-        pass
-    elif info['type'] == 'Folder':
-        items_in_destination = ee.data.getList({'id': asset_path})
-        for item in items_in_destination:
-            logging.info('Removing items in %s folder', item['id'])
-            delete(item['id'])
-    else:
-        items_in_destination = ee.data.getList({'id': asset_path})
-        for item in items_in_destination:
-            ee.data.deleteAsset(item['id'])
-    ee.data.deleteAsset(asset_path)
+        progress = AssetProgress('Deleted', total)
+        # Assets that were not deleted; their ancestors are not empty and are kept as well.
+        kept = set()
+        for depth in reversed(range(len(levels))):
+            level = []
+            for asset_id, parent in levels[depth]:
+                if asset_id in kept:
+                    progress.update(False)
+                    kept.add(parent)
+                else:
+                    level.append((asset_id, parent))
+            for chunk in __chunks(level, chunk_size):
+                for (asset_id, parent), error in zip(chunk, pool.map(__delete_asset, [a for a, _ in chunk])):
+                    if error:
+                        logging.error('Failed to delete %s: %s', asset_id, error)
+                        kept.update((asset_id, parent))
+                    progress.update(error is None)
+        progress.log()
+
+    for asset in filtered_assets:
+        if asset['id'] not in kept:
+            logging.info('Collection %s removed', asset['id'])
+    if progress.failed:
+        logging.error('%d of %d assets could not be deleted', progress.failed, total)
+    return progress.failed
+
+
+def __list_tree(pool, assets):
+    """Returns the tree as a list of levels, each a list of (asset id, parent id), starting from the given assets."""
+    levels = []
+    level = [(asset['id'], None, asset['type']) for asset in assets]
+    while level:
+        levels.append([(asset_id, parent) for asset_id, parent, _ in level])
+        containers = [asset_id for asset_id, _, asset_type in level if asset_type in CONTAINER_TYPES]
+        children = pool.map(list_children, containers)
+        level = [(child['id'], parent, child['type']) for parent, items in zip(containers, children) for child in items]
+        if level:
+            logging.info('Listed %d assets at depth %d', len(level), len(levels))
+    return levels
+
+
+def __delete_asset(asset_id):
+    """Returns None once the asset is gone, or the error that prevented deleting it."""
+    try:
+        __delete_with_retry(asset_id)
+    except ee.EEException as e:
+        # A refused deletion may also be reported as "... does not exist or doesn't allow this operation", so the
+        # asset is only taken as deleted if it can no longer be found.
+        if NOT_FOUND_RE.search(str(e)) and __is_gone(asset_id):
+            logging.debug('%s was already deleted', asset_id)
+            return None
+        return e
+    return None
+
+
+def __is_gone(asset_id):
+    try:
+        return ee.data.getInfo(asset_id) is None
+    except ee.EEException:
+        return False
+
+
+def __is_retryable(exception):
+    return retry_if_ee_error(exception) and not NOT_FOUND_RE.search(str(exception))
+
+
+@retrying.retry(retry_on_exception=__is_retryable, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def __delete_with_retry(asset_id):
+    ee.data.deleteAsset(asset_id)
+
+
+def __chunks(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,93 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import ee
+import retrying
+
+from .metadata_loader import iter_metadata_chunks
+from .tasks import retry_if_ee_error
+
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+MISSING = 'missing'
+FAILED = 'failed'
+
+
+def update_properties(metadata_path, destination_path, workers=10, dry_run=False):
+    """
+    Sets the properties of existing assets from a metadata CSV, in the format used by upload: the first column is
+    the name of the asset in destination_path. The file is read a chunk at a time; for every asset in a chunk the
+    current properties are fetched concurrently and only the properties whose value differs are sent.
+    :param metadata_path: path to the CSV
+    :param destination_path: full path to the folder or collection holding the assets
+    :param workers: (optional) number of concurrent requests
+    :param dry_run: (optional) log what would change without changing anything
+    :return: Counter of assets by outcome: updated, unchanged, missing and failed
+    """
+    counts = collections.Counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for chunk in iter_metadata_chunks(metadata_path):
+            asset_ids = [destination_path + '/' + key for key in chunk]
+            properties = [chunk[key] for key in chunk]
+            for outcome in pool.map(__update_asset, asset_ids, properties, [dry_run] * len(asset_ids)):
+                counts[outcome] += 1
+            logging.info('%d assets processed: %d %s, %d unchanged, %d missing, %d failed', sum(counts.values()),
+                         counts[UPDATED], 'to update' if dry_run else 'updated', counts[UNCHANGED], counts[MISSING],
+                         counts[FAILED])
+    return counts
+
+
+def changed_properties(current, new):
+    """Returns the properties in new whose value is absent from current or different."""
+    return {key: value for key, value in new.items() if key not in current or current[key] != value}
+
+
+def __update_asset(asset_id, properties, dry_run):
+    try:
+        info = __get_info(asset_id)
+        if not info:
+            logging.warning('Asset %s does not exist', asset_id)
+            return MISSING
+        changes = changed_properties(info.get('properties', {}), properties)
+        if not changes:
+            return UNCHANGED
+        if dry_run:
+            logging.info('Would set %s on %s', ', '.join(sorted(changes)), asset_id)
+        else:
+            __set_properties(asset_id, changes)
+            logging.debug('Set %s on %s', ', '.join(sorted(changes)), asset_id)
+        return UPDATED
+    except ee.EEException as e:
+        logging.error('Failed to update %s: %s', asset_id, e)
+        return FAILED
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def __get_info(asset_id):
+    return ee.data.getInfo(asset_id)
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def __set_properties(asset_id, properties):
+    ee.data.setAssetProperties(asset_id, properties)
@@ -19,17 +19,26 @@ __license__ = "Apache 2.0"
 
 import ast
 import csv
+import collections
 import getpass
-import glob
+import itertools
 import logging
 import os
+import re
 import sys
-import time
+import threading
 import ee
 import retrying
 from requests_toolbelt.multipart import encoder
-from google.cloud import storage
-from .metadata_loader import load_metadata_from_csv, validate_metadata_from_csv
+from .metadata_loader import IndexedMetadata, load_metadata_from_csv, validate_metadata_from_csv
+from .discovery import discover_images, group_images
+from .journal import UploadJournal
+from .listing import AssetNameIndex, iter_children
+from .pipeline import Pipeline
+from .preflight import check, inspect_tiff, inspection_pool
+from .staging import BucketCache, create_storage_client, mount_pooled_adapter, stage_file
+from .throughput import TransferMonitor
+from .tasks import TaskIdAllocator, TaskScheduler, retry_if_ee_error
 from .session import get_google_session
 
 
@@ -44,7 +53,24 @@ def upload(
         bucket_name = None,
         band_names = [],
         signal_if_error = False,
-        tolerate_assets_already_exist = True):
+        tolerate_assets_already_exist = True,
+        workers = 1,
+        ingestion_workers = 1,
+        task_id_block_size = 100,
+        max_active_tasks = 20,
+        journal_path = 'upload_journal.sqlite',
+        resume = False,
+        composite_threshold = None,
+        composite_workers = 8,
+        max_bandwidth = None,
+        recursive = False,
+        include = None,
+        exclude = None,
+        metadata_workers = 1,
+        lazy_metadata = False,
+        preflight = True,
+        preflight_workers = None,
+        group_by = None):
     """
     Uploads content of a given directory to GEE. The function first uploads an asset to Google Cloud Storage (GCS)
     and then uses ee.data.startIngestion to put it into GEE, Due to GCS intermediate step, users is asked for
@@ -54,25 +80,54 @@ def upload(
     which the error will be propagated further.
 
     :param user: name of a Google account
-    :param source_path: path to a directory
+    :param source_path: path to a directory; files with .tif or .tiff extension in any case are uploaded
     :param destination_path: where to upload (absolute path)
     :param metadata_path: (optional) path to file with metadata
     :param multipart_upload: (optional) alternative mode op upload - use if the other one fails
     :param nodata_value: (optinal) value to burn into raster for missind data in the image
+    :param workers: (optional) number of images staged concurrently
+    :param ingestion_workers: (optional) number of ingestion requests submitted concurrently
+    :param task_id_block_size: (optional) number of task IDs reserved from GEE in a single request
+    :param max_active_tasks: (optional) number of ingestion tasks of this upload allowed to be queued or running
+    :param journal_path: (optional) SQLite file recording the progress of every asset
+    :param resume: (optional) continue each file from the last step recorded in the journal instead of listing
+    the destination collection
+    :param composite_threshold: (optional) size in bytes above which a file is staged to GCS in parallel parts
+    :param composite_workers: (optional) number of parts of a single file uploaded at the same time
+    :param max_bandwidth: (optional) limit in bytes per second for staging, shared by all workers
+    :param recursive: (optional) include images in subdirectories of source_path
+    :param include: (optional) list of wildcard patterns; only matching files are uploaded
+    :param exclude: (optional) list of wildcard patterns; matching files are skipped
+    :param metadata_workers: (optional) number of processes parsing the metadata file
+    :param lazy_metadata: (optional) index the metadata file (CSV or JSON Lines) and parse each row only when its image
+    is ingested, instead of loading it up front
+    :param preflight: (optional) read the header of every image before staging; images that are corrupt or do not
+    match band_names are rejected, and unless nodata_value is given the nodata value of each image is taken from it
+    :param preflight_workers: (optional) number of processes reading headers; defaults to the number of CPUs
+    :param group_by: (optional) regular expression grouping images into a single asset, see discovery.group_images;
+    the asset name is looked up in metadata instead of the file name
     :return:
     """
-    submitted_tasks_id = {}
-
     __verify_path_for_upload(destination_path)
 
-    path = os.path.join(os.path.expanduser(source_path), '*.tif')
-    all_images_paths = glob.glob(path)
+    if group_by:
+        group_by = __compile_group_pattern(group_by)
+
+    images_paths = discover_images(source_path, recursive=recursive, include=include, exclude=exclude)
+    first_image_path = next(images_paths, None)
 
-    if len(all_images_paths) == 0:
-        logging.error('%s does not contain any tif images.', path)
+    if first_image_path is None:
+        logging.error('%s does not contain any tif images.', source_path)
         sys.exit(1)
 
-    metadata = load_metadata_from_csv(metadata_path) if metadata_path else None
+    images_paths = itertools.chain([first_image_path], images_paths)
+
+    if not metadata_path:
+        metadata = None
+    elif lazy_metadata:
+        metadata = IndexedMetadata(metadata_path)
+    else:
+        metadata = load_metadata_from_csv(metadata_path, workers=metadata_workers)
 
     if user is not None:
         password = getpass.getpass()
@@ -81,80 +136,207 @@ def upload(
                                             password=password,
                                             browser='Chrome',
                                             headless=headless)
+        mount_pooled_adapter(google_session, pool_size=workers)
     else:
-        storage_client = storage.Client()
+        pool_size = workers * composite_workers if composite_threshold else workers
+        buckets = BucketCache(create_storage_client(pool_size=pool_size))
 
     __create_image_collection(destination_path)
 
-    images_for_upload_path = __find_remaining_assets_for_upload(
-        all_images_paths,
-        destination_path,
-        tolerate_assets_already_exist)
-
-    no_images = len(images_for_upload_path)
-
-    if no_images == 0:
-        logging.error('No images found that match %s. Exiting...', path)
-        sys.exit(1)
+    # With --resume the journal tells what is left to do, so the collection is not listed.
+    existing_assets = AssetNameIndex([]) if resume else __get_existing_asset_names(destination_path)
+    counts = collections.Counter()
 
     failed_asset_writer = FailedAssetsWriter()
     got_errors = False
-
-    for current_image_no, image_path in enumerate(images_for_upload_path):
-        logging.info('Processing image %d out of %d: %s', current_image_no+1, no_images, image_path)
-        filename = __get_filename_from_path(path=image_path)
-
-        asset_full_path = destination_path + '/' + filename
-
-        if metadata and not filename in metadata:
-            logging.warning("No metadata exists for image %s: it will not be ingested", filename)
-            failed_asset_writer.writerow([filename, 0, 'Missing metadata'])
-            continue
-
-        properties = metadata[filename] if metadata else None
-
-        try:
+    task_ids = TaskIdAllocator(block_size=task_id_block_size)
+    monitor = TransferMonitor(max_bandwidth=max_bandwidth)
+    journal = UploadJournal(journal_path)
+
+    def on_task_completed(task_id, item):
+        journal.completed(item.path, item.asset_id)
+
+    def on_task_failed(task_id, item, error_message):
+        journal.failed(item.path, item.asset_id, error_message)
+        failed_asset_writer.writerow([item.filename, task_id, error_message])
+        logging.error('Ingestion of image %s has failed with message %s', item.filename, error_message)
+
+    def sources():
+        if group_by:
+            for group in group_images(images_paths, group_by):
+                yield group.name, group.paths, group.bands
+        else:
+            for image_path in images_paths:
+                yield __get_filename_from_path(path=image_path), [image_path], None
+
+    def discover():
+        uploaded_names = set()
+        for filename, image_paths, bands in sources():
+            counts['found'] += 1
+
+            if filename in existing_assets:
+                counts['existing'] += 1
+                continue
+
+            if filename in uploaded_names:
+                logging.warning('%s has the same name as an image found earlier: it will not be ingested',
+                                image_paths[0])
+                failed_asset_writer.writerow([filename, 0, 'Duplicate name: ' + image_paths[0]])
+                continue
+            uploaded_names.add(filename)
+
+            counts['processed'] += 1
+            if len(image_paths) == 1:
+                logging.info('Processing image %d: %s', counts['processed'], image_paths[0])
+            else:
+                logging.info('Processing image %d: %s from %d files', counts['processed'], filename, len(image_paths))
+
+            if bands and len(set(bands)) < len(bands):
+                logging.warning('Files of image %s do not have distinct band names: it will not be ingested', filename)
+                failed_asset_writer.writerow([filename, 0, 'Duplicate band names: ' + ', '.join(bands)])
+                continue
+
+            if metadata and not filename in metadata:
+                logging.warning("No metadata exists for image %s: it will not be ingested", filename)
+                failed_asset_writer.writerow([filename, 0, 'Missing metadata'])
+                continue
+
+            properties = metadata[filename] if metadata else None
+            item = UploadItem(counts['processed'], [os.path.abspath(path) for path in image_paths], filename,
+                              destination_path + '/' + filename, properties, nodata_value, bands)
+
+            if resume:
+                entry = journal.get(item.path, item.asset_id)
+                if entry and entry.state == UploadJournal.COMPLETED:
+                    logging.info('%s has already been ingested', filename)
+                    continue
+                elif entry and entry.state == UploadJournal.SUBMITTED:
+                    logging.info('Ingestion of %s was submitted as task %s. Monitoring it', filename, entry.task_id)
+                    item.task_id = entry.task_id
+                    scheduler.track(entry.task_id, item)
+                    continue
+                elif entry and entry.state == UploadJournal.STAGED and entry.gsid:
+                    # Staged but never submitted: go straight to ingestion. A failed ingestion is staged again, as
+                    # its staged copy may be what made it fail, or may have expired.
+                    item.gsids = entry.gsid.split('\n')
+
+            if not item.gsids:
+                monitor.expect(sum(os.path.getsize(path) for path in item.paths))
+            yield item
+
+    def inspect(item):
+        infos = [preflight_pool.submit(inspect_tiff, path) for path in item.paths]
+        # With one file per band the bands are named by the group pattern, not by band_names.
+        expected_bands = None if item.bands else band_names
+        nodata_values = [check(info.result(), band_names=expected_bands, nodata_value=nodata_value) for info in infos]
+        item.nodata_value = next((value for value in nodata_values if value is not None), None)
+        return item
+
+    def stage(item):
+        if item.gsids:
+            return item
+        for path in item.paths:
             if user is not None:
                 gsid = __upload_file_gee(session=google_session,
-                                         file_path=image_path,
-                                         use_multipart=multipart_upload)
+                                         file_path=path,
+                                         use_multipart=multipart_upload,
+                                         monitor=monitor)
             else:
-                gsid = __upload_file_gcs(storage_client, bucket_name, image_path)
+                gsid = __upload_file_gcs(buckets, bucket_name, path, composite_threshold, composite_workers, monitor)
+            item.gsids.append(gsid)
+        journal.staged(item.path, item.asset_id, '\n'.join(item.gsids))
+        return item
+
+    def submit(item):
+        asset_request = __create_asset_request(item.asset_id, item.gsids, item.properties, item.nodata_value,
+                                               band_names, item.bands)
+        scheduler.acquire()
+        try:
+            item.task_id = __start_ingestion_task(asset_request, task_ids)
+        except Exception:
+            scheduler.release()
+            raise
+        journal.submitted(item.path, item.asset_id, item.task_id)
+        scheduler.submitted(item.task_id, item)
+
+    def on_error(stage_name, item, e):
+        nonlocal got_errors
+        logging.error('Upload of %s has failed at %s: %s', item.filename, stage_name, e, exc_info=e)
+        journal.failed(item.path, item.asset_id, str(e))
+        failed_asset_writer.writerow([item.filename, item.task_id or 0, str(e)])
+        got_errors = True
+
+    # Submitted tasks are monitored by the scheduler, which also holds back the ingestion stage while all task slots
+    # are taken.
+    scheduler = TaskScheduler(max_active_tasks=max_active_tasks, on_failed=on_task_failed,
+                              on_completed=on_task_completed)
+
+    pipeline = Pipeline(on_error=on_error)
+    if preflight:
+        # Headers are parsed in a process pool; the stage threads only wait for the results.
+        preflight_workers = preflight_workers or os.cpu_count() or 1
+        preflight_pool = inspection_pool(preflight_workers)
+        pipeline.add_stage('preflight', inspect, workers=preflight_workers)
+    pipeline.add_stage('staging', stage, workers=workers)
+    pipeline.add_stage('ingestion', submit, workers=ingestion_workers)
+    try:
+        pipeline.run(discover())
+    finally:
+        if preflight:
+            preflight_pool.shutdown()
+        scheduler.close()
+        journal.close()
+        if lazy_metadata and metadata is not None:
+            metadata.close()
+        monitor.summary()
 
-            asset_request = __create_asset_request(asset_full_path, gsid, properties, nodata_value, band_names)
+    failed_asset_writer.close()
 
-            task_id = __start_ingestion_task(asset_request)
-            submitted_tasks_id[task_id] = filename
-            __periodic_check(current_image=current_image_no, period=20, tasks=submitted_tasks_id, writer=failed_asset_writer)
-        except Exception as e:
-            logging.exception('Upload of %s has failed.', filename)
-            failed_asset_writer.writerow([filename, 0, str(e)])
-            got_errors = True
+    if counts['existing']:
+        logging.info('%d of %d images were already in %s and were skipped', counts['existing'], counts['found'],
+                     destination_path)
+    if counts['existing'] == counts['found']:
+        logging.warning('Collection already exists and contains all assets provided for upload.')
+        if not tolerate_assets_already_exist:
+            sys.exit(1)
 
-    __check_for_failed_tasks_and_report(tasks=submitted_tasks_id, writer=failed_asset_writer)
-    failed_asset_writer.close()
     if signal_if_error and got_errors:
         sys.exit(1)
 
 
-def __create_asset_request(asset_full_path, gsid, properties, nodata_value, band_names):
-    if band_names:
-        band_names = [{'id': name} for name in band_names]
+def __create_asset_request(asset_full_path, gsids, properties, nodata_value, band_names, tileset_bands=None):
+    sources = [{"primaryPath": gsid, "additionalPaths": []} for gsid in gsids]
+
+    if tileset_bands:
+        # One single-band tileset per file, each named after its band.
+        tilesets = [{"id": band, "sources": [source]} for band, source in zip(tileset_bands, sources)]
+        band_names = [{'id': band, 'tilesetId': band, 'tilesetBandIndex': 0} for band in tileset_bands]
+    else:
+        # All files are tiles of the same mosaic.
+        tilesets = [{"sources": sources}]
+        if band_names:
+            band_names = [{'id': name} for name in band_names]
 
     return {"id": asset_full_path,
-            "tilesets": [
-                {"sources": [
-                    {"primaryPath": gsid,
-                     "additionalPaths": []
-                     }
-                ]}
-            ],
+            "tilesets": tilesets,
             "bands": band_names,
             "properties": properties,
             "missingData": {"values": [nodata_value]}
             }
 
 
+def __compile_group_pattern(pattern):
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        logging.error('%s is not a valid regular expression: %s', pattern, e)
+        sys.exit(1)
+    if not compiled.groups:
+        logging.error('Grouping pattern %s needs a group capturing the asset name, e.g. (.+)_tile\\d+', pattern)
+        sys.exit(1)
+    return compiled
+
+
 def __verify_path_for_upload(path):
     folder = path[:path.rfind('/')]
     response = ee.data.getInfo(folder)
@@ -164,43 +346,28 @@ def __verify_path_for_upload(path):
         sys.exit(1)
 
 
-def __find_remaining_assets_for_upload(path_to_local_assets, path_remote, tolerate_assets_already_exist):
-    local_assets = [__get_filename_from_path(path) for path in path_to_local_assets]
+def __get_existing_asset_names(path_remote):
     if __collection_exist(path_remote):
-        remote_assets = __get_asset_names_from_collection(path_remote)
+        remote_assets = AssetNameIndex(os.path.basename(asset['id']) for asset in iter_children(path_remote))
         if len(remote_assets) > 0:
-            assets_left_for_upload = set(local_assets) - set(remote_assets)
-            if len(assets_left_for_upload) == 0:
-                logging.warning('Collection already exists and contains all assets provided for upload. Exiting ...')
-                if tolerate_assets_already_exist:
-                    sys.exit(0)
-                else:
-                    sys.exit(1)
-
-            logging.info('Collection already exists. %d assets left for upload to %s.', len(assets_left_for_upload), path_remote)
-            assets_left_for_upload_full_path = [path for path in path_to_local_assets
-                                                if __get_filename_from_path(path) in assets_left_for_upload]
-            return assets_left_for_upload_full_path
-
-    return path_to_local_assets
-
-
-def retry_if_ee_error(exception):
-    return isinstance(exception, ee.EEException)
+            logging.info('Collection already exists and contains %d assets. They will not be uploaded again.',
+                         len(remote_assets))
+        return remote_assets
+    return AssetNameIndex([])
 
 
 @retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
-def __start_ingestion_task(asset_request):
-    task_id = ee.data.newTaskId(1)[0]
+def __start_ingestion_task(asset_request, task_ids):
+    # A fresh ID is taken on every attempt; an ID is never sent twice.
+    task_id = task_ids.next()
     _ = ee.data.startIngestion(task_id, asset_request)
     return task_id
 
 
 def __validate_metadata(path_for_upload, metadata_path):
     validation_result = validate_metadata_from_csv(metadata_path)
-    keys_in_metadata = {result.keys for result in validation_result}
-    images_paths = glob.glob(os.path.join(path_for_upload, '*.tif*'))
-    keys_in_data = {__get_filename_from_path(path) for path in images_paths}
+    keys_in_metadata = set(validation_result.keys)
+    keys_in_data = {__get_filename_from_path(path) for path in discover_images(path_for_upload)}
     missing_keys = keys_in_data - keys_in_metadata
 
     if missing_keys:
@@ -235,20 +402,33 @@ def __get_upload_url(session):
 
 
 @retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
-def __upload_file_gee(session, file_path, use_multipart):
+def __upload_file_gee(session, file_path, use_multipart, monitor=None):
     with open(file_path, 'rb') as f:
         upload_url = __get_upload_url(session)
 
-        if use_multipart:
-            form = encoder.MultipartEncoder({
-                "documents": (file_path, f, "application/octet-stream"),
-                "composite": "NONE",
-            })
-            headers = {"Prefer": "respond-async", "Content-Type": form.content_type}
-            resp = session.post(upload_url, headers=headers, data=form)
-        else:
-            files = {'file': f}
-            resp = session.post(upload_url, files=files)
+        if monitor:
+            monitor.file_started(file_path, os.path.getsize(file_path))
+            f = monitor.wrap(f, file_path)
+
+        try:
+            if use_multipart:
+                form = encoder.MultipartEncoder({
+                    "documents": (file_path, f, "application/octet-stream"),
+                    "composite": "NONE",
+                })
+                headers = {"Prefer": "respond-async", "Content-Type": form.content_type}
+                resp = session.post(upload_url, headers=headers, data=form)
+            elif monitor:
+                # files= reads the whole file into the request body before anything is sent, so the monitor would
+                # count disk reads and the limiter would be drained at once. A streamed form is read as it is sent.
+                form = encoder.MultipartEncoder({'file': (os.path.basename(file_path), f, 'application/octet-stream')})
+                resp = session.post(upload_url, headers={'Content-Type': form.content_type}, data=form)
+            else:
+                files = {'file': f}
+                resp = session.post(upload_url, files=files)
+        finally:
+            if monitor:
+                monitor.file_finished(file_path)
 
         gsid = resp.json()[0]
 
@@ -256,59 +436,16 @@ def __upload_file_gee(session, file_path, use_multipart):
 
 
 @retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
-def __upload_file_gcs(storage_client, bucket_name, image_path):
-    bucket = storage_client.get_bucket(bucket_name)
-    blob_name = __get_filename_from_path(path=image_path)
-    blob = bucket.blob(blob_name)
-
-    blob.upload_from_filename(image_path)
-
-    url = 'gs://' + bucket_name + '/' + blob_name
-
-    return url
-
-def __periodic_check(current_image, period, tasks, writer):
-    if (current_image + 1) % period == 0:
-        logging.info('Periodic check')
-        __check_for_failed_tasks_and_report(tasks=tasks, writer=writer)
-        # Time to check how many tasks are running!
-        __wait_for_tasks_to_complete(waiting_time=10, no_allowed_tasks_running=20)
-
-
-def __check_for_failed_tasks_and_report(tasks, writer):
-    if len(tasks) == 0:
-        return
-
-    statuses = ee.data.getTaskStatus(tasks.keys())
-
-    for status in statuses:
-        if status['state'] == 'FAILED':
-            task_id = status['id']
-            filename = tasks[task_id]
-            error_message = status['error_message']
-            writer.writerow([filename, task_id, error_message])
-            logging.error('Ingestion of image %s has failed with message %s', filename, error_message)
-
-    tasks.clear()
+def __upload_file_gcs(buckets, bucket_name, image_path, composite_threshold, composite_workers, monitor):
+    bucket = buckets.get(bucket_name)
+    return stage_file(bucket, image_path, composite_threshold=composite_threshold, composite_workers=composite_workers,
+                      monitor=monitor)
 
 
 def __get_filename_from_path(path):
     return os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
 
 
-def __get_number_of_running_tasks():
-    return len([task for task in ee.data.getTaskList() if task['state'] == 'RUNNING'])
-
-
-def __wait_for_tasks_to_complete(waiting_time, no_allowed_tasks_running):
-    tasks_running = __get_number_of_running_tasks()
-    while tasks_running > no_allowed_tasks_running:
-        logging.info('Number of running tasks is %d. Sleeping for %d s until it goes down to %d',
-                     tasks_running, waiting_time, no_allowed_tasks_running)
-        time.sleep(waiting_time)
-        tasks_running = __get_number_of_running_tasks()
-
-
 def __collection_exist(path):
     return True if ee.data.getInfo(path) else False
 
@@ -321,29 +458,42 @@ def __create_image_collection(full_path_to_collection):
         logging.info('New collection %s created', full_path_to_collection)
 
 
-def __get_asset_names_from_collection(collection_path):
-    assets_list = ee.data.getList(params={'id': collection_path})
-    assets_names = [os.path.basename(asset['id']) for asset in assets_list]
-    return assets_names
+class UploadItem(object):
+
+    def __init__(self, number, paths, filename, asset_id, properties, nodata_value=None, bands=None):
+        self.number = number
+        self.paths = paths
+        # Key in the journal; staged IDs of a group are stored there joined the same way.
+        self.path = '\n'.join(paths)
+        self.filename = filename
+        self.asset_id = asset_id
+        self.properties = properties
+        self.nodata_value = nodata_value
+        self.bands = bands
+        self.gsids = []
+        self.task_id = None
 
 
 class FailedAssetsWriter(object):
 
     def __init__(self):
         self.initialized = False
+        self.lock = threading.Lock()
 
     def writerow(self, row):
+        with self.lock:
+            self._writerow(row)
+
+    def _writerow(self, row):
         if not self.initialized:
-            if sys.version_info > (3, 0):
-                self.failed_upload_file = open('failed_upload.csv', 'w')
-            else:
-                self.failed_upload_file = open('failed_upload.csv', 'wb')
+            self.failed_upload_file = open('failed_upload.csv', 'w')
             self.failed_upload_writer = csv.writer(self.failed_upload_file)
             self.failed_upload_writer.writerow(['filename', 'task_id', 'error_msg'])
             self.initialized = True
         self.failed_upload_writer.writerow(row)
 
     def close(self):
-        if self.initialized:
-            self.failed_upload_file.close()
-            self.initialized = False
+        with self.lock:
+            if self.initialized:
+                self.failed_upload_file.close()
+                self.initialized = False
@@ -59,6 +59,12 @@ default_config = {
         }
     },
 
+    "loggers": {
+        "gee_asset_manager.progress": {
+            "level": "INFO"
+        }
+    },
+
     "root": {
         "level": "INFO",
         "handlers": ["console", "info_file_handler", "error_file_handler"]
@@ -0,0 +1,116 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import collections
+import fnmatch
+import logging
+import os
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff')
+
+ImageGroup = collections.namedtuple('ImageGroup', ['name', 'paths', 'bands'])
+
+
+def discover_images(source_path, recursive=False, include=None, exclude=None, extensions=IMAGE_EXTENSIONS):
+    """
+    Lazily yields paths of images in a directory, so that uploading can start before the walk is over. Extensions
+    are matched regardless of case.
+
+    Include and exclude patterns are Unix-like wildcards matched against both the file name and the path relative
+    to source_path, e.g. '2019-*/*' or '*_B4.tif'. A file is yielded if it matches any include pattern (or none were
+    given) and no exclude pattern.
+
+    :param source_path: directory to search
+    :param recursive: (optional) descend into subdirectories
+    :param include: (optional) list of patterns a file must match
+    :param exclude: (optional) list of patterns that reject a file
+    :param extensions: (optional) accepted file extensions, lowercase
+    :return: generator of paths
+    """
+    root = os.path.expanduser(source_path)
+    pending = [root]
+
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            logging.warning('Cannot read directory %s: %s', directory, e)
+            continue
+
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if recursive:
+                        subdirectories.append(entry.path)
+                    continue
+                if not entry.name.lower().endswith(extensions):
+                    continue
+                relative_path = os.path.relpath(entry.path, root)
+                if include and not _matches_any(entry.name, relative_path, include):
+                    continue
+                if exclude and _matches_any(entry.name, relative_path, exclude):
+                    continue
+                yield entry.path
+
+        # Files are yielded in directory order as they are read; subdirectories are visited depth-first in name
+        # order, so date-named directories come out chronologically.
+        pending.extend(sorted(subdirectories, reverse=True))
+
+
+def group_images(image_paths, pattern):
+    """
+    Groups images that make up a single asset, e.g. the tiles of a scene or its bands in separate files. The pattern
+    is searched for in the file name without extension; the asset name is the named group 'asset', or the first group
+    if there is no such name. Images of a group become sources of one tileset, unless the pattern also has a named
+    group 'band': then every image is a tileset of its own and the group gives the id of its band.
+
+    The whole input is read before the first group is returned. Images not matching the pattern form groups of one,
+    named after the file.
+
+    :param image_paths: iterable of image paths
+    :param pattern: compiled regular expression
+    :return: list of ImageGroup in the order the first image of each group was found; bands is None unless a 'band'
+    group matched
+    """
+    asset_group = 'asset' if 'asset' in pattern.groupindex else 1
+    by_band = 'band' in pattern.groupindex
+    groups = collections.OrderedDict()
+
+    for path in image_paths:
+        filename = os.path.splitext(os.path.basename(path))[0]
+        match = pattern.search(filename)
+        name = match.group(asset_group) if match else None
+        band = match.group('band') if match and by_band else None
+        paths, bands = groups.setdefault(name or filename, ([], []))
+        paths.append(path)
+        bands.append(band)
+
+    return [ImageGroup(name, paths, _band_names(paths, bands)) for name, (paths, bands) in groups.items()]
+
+
+def _band_names(paths, bands):
+    if not any(bands):
+        return None
+    return [band or os.path.splitext(os.path.basename(path))[0] for path, band in zip(paths, bands)]
+
+
+def _matches_any(name, relative_path, patterns):
+    return any(fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
@@ -0,0 +1,150 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import collections
+import sqlite3
+import threading
+import time
+
+JournalEntry = collections.namedtuple('JournalEntry', ['path', 'asset_id', 'state', 'gsid', 'task_id', 'error'])
+
+
+class SQLiteStore(object):
+
+    def __init__(self, filename, schema=()):
+        """
+        Base of the on-disk stores: an SQLite database, created if it does not exist, whose connection may be used
+        from any thread. Stores shared between threads hold self._lock around every use of the connection.
+        Write-ahead logging with normal synchronisation keeps commits cheap, and committed writes survive a crash
+        of the process.
+        :param filename: path to the database
+        :param schema: (optional) statements run when the database is opened, e.g. CREATE TABLE IF NOT EXISTS
+        """
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in schema:
+                self._connection.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+class UploadJournal(SQLiteStore):
+
+    STAGED = 'STAGED'
+    SUBMITTED = 'SUBMITTED'
+    COMPLETED = 'COMPLETED'
+    FAILED = 'FAILED'
+
+    def __init__(self, filename):
+        """
+        On-disk record of the progress of every asset in an upload, keyed by local file and destination asset.
+        Each step is committed as soon as it happens, so after a crash the upload can continue from the last step
+        each file reached.
+        :param filename: path to the SQLite database
+        """
+        super(UploadJournal, self).__init__(filename, ['CREATE TABLE IF NOT EXISTS uploads ('
+                                                       'path TEXT NOT NULL, '
+                                                       'asset_id TEXT NOT NULL, '
+                                                       'state TEXT NOT NULL, '
+                                                       'gsid TEXT, '
+                                                       'task_id TEXT, '
+                                                       'error TEXT, '
+                                                       'updated REAL NOT NULL, '
+                                                       'PRIMARY KEY (path, asset_id))'])
+
+    def get(self, path, asset_id):
+        with self._lock:
+            row = self._connection.execute('SELECT path, asset_id, state, gsid, task_id, error FROM uploads '
+                                           'WHERE path = ? AND asset_id = ?', (path, asset_id)).fetchone()
+        return JournalEntry(*row) if row else None
+
+    def task_ids(self):
+        """Returns (task_id, asset_id) of every asset whose ingestion was submitted."""
+        with self._lock:
+            return self._connection.execute('SELECT task_id, asset_id FROM uploads '
+                                            'WHERE task_id IS NOT NULL').fetchall()
+
+    def staged(self, path, asset_id, gsid):
+        self._write(path, asset_id, self.STAGED, gsid=gsid, task_id=None)
+
+    def submitted(self, path, asset_id, task_id):
+        self._write(path, asset_id, self.SUBMITTED, task_id=task_id)
+
+    def completed(self, path, asset_id):
+        self._write(path, asset_id, self.COMPLETED)
+
+    def failed(self, path, asset_id, error):
+        self._write(path, asset_id, self.FAILED, error=error)
+
+    def _write(self, path, asset_id, state, **columns):
+        # Columns that are not given keep their previous value, e.g. a failed ingestion keeps its staged gsid for
+        # reference. Resuming only reuses the gsid of entries still STAGED.
+        names = ['state', 'updated'] + sorted(columns)
+        values = [state, time.time()] + [columns[name] for name in sorted(columns)]
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO uploads (path, asset_id, {names}) VALUES (?, ?, {marks}) '
+                'ON CONFLICT (path, asset_id) DO UPDATE SET {updates}'.format(
+                    names=', '.join(names),
+                    marks=', '.join('?' * len(names)),
+                    updates=', '.join('{0} = excluded.{0}'.format(name) for name in names)),
+                [path, asset_id] + values)
+
+
+class CopyJournal(SQLiteStore):
+
+    COPIED = 'COPIED'
+    FAILED = 'FAILED'
+
+    def __init__(self, filename):
+        """
+        On-disk record of every asset of a copy, keyed by source asset, so that an interrupted copy can skip what
+        is done already.
+        :param filename: path to the SQLite database
+        """
+        super(CopyJournal, self).__init__(filename, ['CREATE TABLE IF NOT EXISTS copies ('
+                                                     'source TEXT PRIMARY KEY, '
+                                                     'destination TEXT NOT NULL, '
+                                                     'state TEXT NOT NULL, '
+                                                     'error TEXT, '
+                                                     'updated REAL NOT NULL)'])
+
+    def is_copied(self, source, destination):
+        with self._lock:
+            row = self._connection.execute('SELECT state FROM copies WHERE source = ? AND destination = ?',
+                                           (source, destination)).fetchone()
+        return bool(row) and row[0] == self.COPIED
+
+    def copied(self, source, destination):
+        self._write(source, destination, self.COPIED, None)
+
+    def failed(self, source, destination, error):
+        self._write(source, destination, self.FAILED, error)
+
+    def _write(self, source, destination, state, error):
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO copies (source, destination, state, error, updated) '
+                                     'VALUES (?, ?, ?, ?, ?)', (source, destination, state, error, time.time()))
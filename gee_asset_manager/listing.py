@@ -0,0 +1,154 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import array
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import ee
+import retrying
+
+from .tasks import retry_if_ee_error
+
+LEGACY_ASSET_PREFIX = 'projects/earthengine-legacy/assets/'
+
+# Asset types reported by the Cloud API mapped to the names used by ee.data.getList and ee.data.getInfo.
+ASSET_TYPES = {
+    'IMAGE': 'Image',
+    'IMAGE_COLLECTION': ee.data.ASSET_TYPE_IMAGE_COLL,
+    'FOLDER': ee.data.ASSET_TYPE_FOLDER,
+    'TABLE': 'Table',
+}
+
+# Assets that contain other assets.
+CONTAINER_TYPES = (ee.data.ASSET_TYPE_FOLDER, ee.data.ASSET_TYPE_IMAGE_COLL)
+
+
+def iter_children(parent, page_size=1000):
+    """
+    Yields the children of a folder or an image collection one page at a time, so that listing a huge collection
+    never holds more than a page of results. Each child is a dictionary in the ee.data.getList format, i.e. with
+    at least 'id' and 'type'.
+    :param parent: full path to a folder or a collection
+    :param page_size: number of children fetched per request
+    :return: generator of dictionaries
+    """
+    if not hasattr(ee.data, 'listAssets'):
+        # Older versions of the API have no pagination.
+        for asset in ee.data.getList({'id': parent}):
+            yield asset
+        return
+
+    params = {'parent': parent, 'pageSize': page_size}
+    while True:
+        response = ee.data.listAssets(params)
+        for asset in response.get('assets', []):
+            yield _to_legacy_format(asset)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+        params['pageToken'] = page_token
+
+
+def walk(parents, workers=8, descend=(ee.data.ASSET_TYPE_FOLDER,), on_listed=None, on_error=None):
+    """
+    Yields every asset below the given parents, listing many containers at the same time. Children of a container
+    are yielded together, as soon as its listing is complete, so the order is breadth-first only roughly; a child
+    always comes after its parent.
+    :param parents: full paths of folders or collections to start from; they are not yielded themselves
+    :param workers: (optional) number of containers listed concurrently
+    :param descend: (optional) types of assets whose children are listed as well
+    :param on_listed: (optional) called with (container, children) once a listing is complete, before the children
+    are yielded
+    :param on_error: (optional) called with (container, exception) when a container cannot be listed; by default a
+    warning is logged. Either way the walk goes on as if the container was empty
+    :return: generator of dictionaries in the ee.data.getList format
+    """
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {pool.submit(_list_with_parent, parent) for parent in parents}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                parent, children, error = future.result()
+                if error is not None:
+                    if on_error:
+                        on_error(parent, error)
+                    else:
+                        logging.warning('Skipped %s, which could not be listed: %s', parent, error)
+                if on_listed:
+                    on_listed(parent, children)
+                for asset in children:
+                    if asset['type'] in descend:
+                        pending.add(pool.submit(_list_with_parent, asset['id']))
+                    yield asset
+
+
+def _list_with_parent(parent):
+    try:
+        return parent, list_children(parent), None
+    except ee.EEException as e:
+        return parent, [], e
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def list_children(parent):
+    """Returns all children of a folder or a collection, retrying on Earth Engine errors."""
+    return list(iter_children(parent))
+
+
+def _to_legacy_format(asset):
+    asset = dict(asset)
+    if 'id' not in asset:
+        name = asset['name']
+        asset['id'] = name[len(LEGACY_ASSET_PREFIX):] if name.startswith(LEGACY_ASSET_PREFIX) else name
+    asset['type'] = ASSET_TYPES.get(asset['type'], asset['type'])
+    return asset
+
+
+class AssetNameIndex(object):
+
+    def __init__(self, names):
+        """
+        Compact set of asset names for membership tests. The names are sorted and stored UTF-8 encoded in a single
+        bytes object, with an array of their offsets: about 8 bytes per name on top of the names themselves, instead
+        of the ~50 bytes of overhead of a str in a set. Lookups are exact binary searches.
+        :param names: iterable of names; consumed once
+        """
+        encoded = sorted(set(name.encode('utf-8') for name in names))
+        self._offsets = array.array('Q', [0])
+        for name in encoded:
+            self._offsets.append(self._offsets[-1] + len(name))
+        self._data = b''.join(encoded)
+
+    def __contains__(self, name):
+        key = name.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low < len(self) and self._name(low) == key
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _name(self, position):
+        return self._data[self._offsets[position]:self._offsets[position + 1]]
@@ -17,47 +17,65 @@ __copyright__ = """
 """
 __license__ = "Apache 2.0"
 
+import array
 import ast
 import collections
 import csv
+import io
+import itertools
+import json
+import locale
 import logging
+import mmap
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 
 ValidationResult = collections.namedtuple('ValidationResult', ['success', 'keys'])
+MetadataError = collections.namedtuple('MetadataError', ['row', 'column', 'message'])
+
+# Number of rows used to infer the type of each column.
+SAMPLE_SIZE = 1000
+# Number of rows converted at a time, column by column.
+CHUNK_SIZE = 10000
+
+GOOGLE_SPECIAL_PROPERTIES = ('system:description',
+                             'system:provider_url',
+                             'system:tags',
+                             'system:time_end',
+                             'system:time_start',
+                             'system:title')
+
+PROPERTY_KEY_RE = re.compile(r'[A-Za-z0-9_]+')
+INT_RE = re.compile(r'[-+]?(0|[1-9][0-9]*)')
+# Integers with leading zeros are not numbers to ast.literal_eval, so they are not numbers here either.
+FLOAT_RE = re.compile(r'[-+]?([0-9]+\.[0-9]*|\.[0-9]+|0|[1-9][0-9]*)([eE][-+]?[0-9]+)?')
 
 
 class IllegalPropertyName(Exception):
     pass
 
 
-def validate_metadata_from_csv(path):
+def validate_metadata_from_csv(path, workers=1):
     """
     Check if metadata is ok
     :param path:
-    :return: true / false
+    :param workers: (optional) number of processes parsing the file
+    :return: ValidationResult with success flag and all keys
     """
-    all_keys = []
+    logging.info('Running metatdata validator for %s', path)
+    metadata, report = load_and_validate_metadata(path, workers=workers)
 
-    with open(path, mode='r') as metadata_file:
-        logging.info('Running metatdata validator for %s', path)
-        success = True
-        reader = csv.reader(metadata_file)
-        header = next(reader)
+    if report.has_header_errors:
+        raise IllegalPropertyName('The header has illegal name.')
 
-        if not properties_allowed(properties=header, validator=allowed_property_key):
-            raise IllegalPropertyName('The header has illegal name.')
+    report.log()
+    logging.info('Validation successful') if report.success else logging.error('Validation failed')
 
-        for row in reader:
-            all_keys.append(row[0])
-            if not properties_allowed(properties=row, validator=allowed_property_value):
-                success = False
+    return ValidationResult(success=report.success, keys=list(metadata.keys()))
 
-        logging.info('Validation successful') if success else logging.error('Validation failed')
 
-        return ValidationResult(success=success, keys=all_keys)
-
-
-def load_metadata_from_csv(path):
+def load_metadata_from_csv(path, workers=1):
     """
     Grabs properties from the give csv file. The csv should be organised as follows:
     filename (without extension), property1, property2, ...
@@ -74,29 +92,507 @@ def load_metadata_from_csv(path):
     { id_no: my_file_1, class: GASTROPODA, category: EN, binomial: Aaadonta constricta},
     { id_no: my_file_2, class: GASTROPODA, category: CR, binomial: Aaadonta irregularis}
 
+    The type of every column is inferred from the first rows (see ColumnarMetadata) and the values are kept
+    column by column; the dictionary for an image is only built when it is looked up. Illegal values are reported
+    in the log.
+
     :param path to csv:
-    :return: dictionary of dictionaries
+    :param workers: (optional) number of processes parsing the file
+    :return: ColumnarMetadata, a read-only mapping of filename to dictionary of properties
     """
-    with open(path, mode='r') as metadata_file:
+    metadata, report = load_and_validate_metadata(path, workers=workers)
+
+    if report.has_header_errors:
+        raise IllegalPropertyName()
+
+    report.log()
+    return metadata
+
+
+def load_and_validate_metadata(path, workers=1):
+    """
+    Reads a metadata CSV once, checking property names and values, converting values and building the lookup
+    structure in the same pass.
+
+    With more than one worker the file is split into byte ranges at line breaks and the ranges are parsed in
+    separate processes. Values containing line breaks are therefore only supported with a single worker.
+
+    :param path: path to csv
+    :param workers: (optional) number of processes parsing the file
+    :return: tuple of ColumnarMetadata and MetadataReport
+    """
+    report = MetadataReport()
+
+    with open(path, mode='r', newline='') as metadata_file:
         reader = csv.reader(metadata_file)
         header = next(reader)
+        report.check_header(header)
 
-        if not properties_allowed(properties=header, validator=allowed_property_key):
-            raise IllegalPropertyName()
+        if workers <= 1:
+            return ColumnarMetadata.from_rows(header, reader, report=report), report
 
-        metadata = {}
+        sample = [_fit_row(row, len(header)) for row in itertools.islice(reader, SAMPLE_SIZE)]
+        kinds = _infer_column_types(sample, len(header))
 
-        for row in reader:
-#            if properties_allowed(properties=row, validator=allowed_property_value):
-            values = []
-            for item in row:
-                try:
-                    values.append(ast.literal_eval(item))
-                except (ValueError, SyntaxError) as e:
-                    values.append(item)
-            metadata[row[0]] = dict(zip(header, values))
+    ranges = _split_at_line_breaks(path, workers * 4)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunks = executor.map(_load_byte_range, itertools.repeat(path), ranges, itertools.repeat(header),
+                              itertools.repeat(kinds))
+        return ColumnarMetadata.merge(header, chunks, report), report
 
-        return metadata
+
+def iter_metadata_chunks(path, chunk_size=CHUNK_SIZE):
+    """
+    Reads a metadata CSV a chunk of rows at a time, for files that need not be held in memory at once. Column types
+    are inferred from the first SAMPLE_SIZE rows, as in load_metadata_from_csv. Illegal values are logged chunk by
+    chunk; duplicate keys are only detected within a chunk.
+    :param path: path to csv
+    :param chunk_size: (optional) number of rows in a chunk
+    :return: generator of ColumnarMetadata
+    """
+    with open(path, mode='r', newline='') as metadata_file:
+        reader = csv.reader(metadata_file)
+        header = next(reader)
+        report = MetadataReport()
+        report.check_header(header)
+        if report.has_header_errors:
+            raise IllegalPropertyName()
+
+        sample = [_fit_row(row, len(header)) for row in itertools.islice(reader, SAMPLE_SIZE)]
+        kinds = _infer_column_types(sample, len(header))
+        rows = itertools.chain(sample, reader)
+        first_row = 2
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            report = MetadataReport()
+            yield ColumnarMetadata.from_rows(header, chunk, kinds=kinds, report=report, first_row=first_row)
+            report.log()
+            first_row += len(chunk)
+
+
+class MetadataReport(object):
+
+    def __init__(self):
+        """Problems found in a metadata file, with their row (line of the file for single-line rows) and column."""
+        self.errors = []
+        self.has_header_errors = False
+
+    @property
+    def success(self):
+        return not self.errors
+
+    def add(self, row, column, message):
+        self.errors.append(MetadataError(row, column, message))
+
+    def check_header(self, header):
+        for name in header:
+            if not allowed_property_key(name):
+                self.has_header_errors = True
+                self.add(1, name, 'Illegal property name')
+
+    def log(self, limit=20):
+        for error in self.errors[:limit]:
+            logging.warning('Metadata row %d, column %s: %s', error.row, error.column, error.message)
+        if len(self.errors) > limit:
+            logging.warning('... and %d more problems with metadata', len(self.errors) - limit)
+
+
+class ColumnarMetadata(object):
+
+    def __init__(self, header, columns, index):
+        """
+        Properties of many images stored column-wise. Integer and float columns are kept in arrays, other columns in
+        lists, and a dictionary maps every key (the first column, as written in the file) to its row.
+        :param header: property names
+        :param columns: list of sequences, one per property
+        :param index: dictionary of key to row number
+        """
+        self.header = header
+        self.columns = columns
+        self.index = index
+
+    @classmethod
+    def from_rows(cls, header, rows, kinds=None, report=None, first_row=2):
+        """
+        Builds the columns from an iterable of rows of strings. The type of each column - int, float, Python literal
+        or plain string - is inferred once from the first SAMPLE_SIZE rows, unless given; then values are converted a
+        chunk at a time with the parser of their column. Values that do not fit the inferred type are parsed one by
+        one as Python literals, falling back to the string itself, as they always were.
+        :param header: property names
+        :param rows: iterable of lists of strings
+        :param kinds: (optional) column types, as returned by infer_column_type
+        :param report: (optional) MetadataReport collecting illegal values and duplicate keys
+        :param first_row: number of the first row in the reports
+        """
+        rows = iter(rows)
+        width = len(header)
+        report = report if report is not None else MetadataReport()
+
+        def next_chunk(size):
+            return [_fit_row(row, width) for row in itertools.islice(rows, size)]
+
+        if kinds is None:
+            sample = next_chunk(SAMPLE_SIZE)
+            kinds = _infer_column_types(sample, width)
+        else:
+            sample = []
+
+        columns = [_ColumnBuilder(kind) for kind in kinds]
+        index = {}
+        row_count = 0
+
+        for chunk in itertools.chain([sample], iter(lambda: next_chunk(CHUNK_SIZE), [])):
+            for offset, row in enumerate(chunk):
+                if row[0] in index:
+                    report.add(first_row + row_count + offset, header[0],
+                               'Duplicate key {}; the last row is used'.format(row[0]))
+                index[row[0]] = row_count + offset
+            for name, column, values in zip(header, columns, zip(*chunk)):
+                for offset in column.extend(values):
+                    report.add(first_row + row_count + offset, name, 'Illegal value {!r}'.format(values[offset]))
+            row_count += len(chunk)
+
+        return cls(header, [column.values for column in columns], index)
+
+    @classmethod
+    def merge(cls, header, parts, report):
+        """
+        Joins metadata loaded in parts, in order. Rows in the reports of the parts are counted from 0 and are moved
+        after the rows of the parts before them.
+        """
+        columns = None
+        index = {}
+        row_count = 0
+
+        for part, part_report in parts:
+            for error in part_report.errors:
+                report.add(error.row + row_count + 2, error.column, error.message)
+            for key, row in part.index.items():
+                if key in index:
+                    report.add(row + row_count + 2, header[0], 'Duplicate key {}; the last row is used'.format(key))
+                index[key] = row + row_count
+            if columns is None:
+                columns = part.columns
+            else:
+                columns = [_concatenate(column, values) for column, values in zip(columns, part.columns)]
+            row_count += len(part)
+
+        return cls(header, columns or [[] for _ in header], index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, key):
+        row = self.index[key]
+        return {name: column[row] for name, column in zip(self.header, self.columns) if column[row] is not None}
+
+    def get(self, key, default=None):
+        return self[key] if key in self.index else default
+
+    def keys(self):
+        return self.index.keys()
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        """Number of rows; may exceed the number of keys if keys are repeated."""
+        return len(self.columns[0]) if self.columns else 0
+
+
+class IndexedMetadata(object):
+
+    # Slots of the hash table hold (16-bit tag of the key hash << 48) | (offset of the row + 1); 0 marks an empty slot.
+    _TAG_SHIFT = 48
+    _OFFSET_MASK = (1 << 48) - 1
+
+    def __init__(self, path, key=None):
+        """
+        Metadata read on demand from a memory-mapped CSV or JSON Lines file (.jsonl or .ndjson). Opening the file only
+        builds a hash table of key to byte offset, 16 bytes per row, and no row is parsed until it is looked up, so
+        memory use does not depend on the size of the file. Every row must be on a single line.
+
+        In a CSV file the key is the first column and the type of each column is inferred from the first rows, as in
+        ColumnarMetadata. In a JSON Lines file every line is an object and the key is the value of its key field.
+
+        :param path: path to the file
+        :param key: (optional) name of the key field in a JSON Lines file; defaults to the first field of the first line
+        """
+        self.path = path
+        self.encoding = locale.getpreferredencoding(False)
+        self.is_jsonl = os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson')
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.row_count = 0
+
+        if self.is_jsonl:
+            first_line = self._data[:self._line_end(0)]
+            if key is None and first_line.strip():
+                key = next(iter(json.loads(first_line.decode(self.encoding))))
+            self.key = key
+            # Fast path for string keys; other values are found by parsing the line.
+            self._key_pattern = re.compile(br'"' + re.escape(json.dumps(self.key).strip('"').encode(self.encoding)) +
+                                           br'"\s*:\s*"([^"\\]*)"')
+            self.header = None
+            self.kinds = None
+            data_start = 0
+        else:
+            header_end = self._line_end(0)
+            self.header = next(csv.reader([self._data[:header_end].decode(self.encoding).rstrip('\r')]))
+            if not properties_allowed(properties=self.header, validator=allowed_property_key):
+                raise IllegalPropertyName()
+            data_start = header_end + 1
+
+        self._slots = array.array('Q', bytes(8 * 1024))
+        self._build_index(data_start)
+
+        if not self.is_jsonl:
+            sample = [_fit_row(row, len(self.header))
+                      for row in csv.reader(self._lines(data_start, SAMPLE_SIZE))]
+            self.kinds = _infer_column_types(sample, len(self.header))
+
+        logging.info('Indexed %d rows of metadata in %s', self.row_count, path)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        offset = self._find(key)
+        if offset is None:
+            raise KeyError(key)
+        line = self._data[offset:self._line_end(offset)].decode(self.encoding).rstrip('\r')
+        if self.is_jsonl:
+            return json.loads(line)
+        row = _fit_row(next(csv.reader([line])), len(self.header))
+        values = [_PARSERS[kind](value) for kind, value in zip(self.kinds, row)]
+        return {name: value for name, value in zip(self.header, values) if value is not None}
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __len__(self):
+        return self.row_count
+
+    def close(self):
+        if self._data:
+            self._data.close()
+        self._file.close()
+
+    def _build_index(self, position):
+        size = len(self._data)
+        while position < size:
+            end = self._line_end(position)
+            if self._data[position:end].strip():
+                self._insert(self._key_at(position, end), position)
+            position = end + 1
+
+    def _insert(self, key, offset):
+        if 2 * (self.row_count + 1) > len(self._slots):
+            self._grow()
+        slot, tag = self._place(key)
+        mask = len(self._slots) - 1
+        while self._slots[slot]:
+            entry = self._slots[slot]
+            if entry >> self._TAG_SHIFT == tag and self._key_at_offset((entry & self._OFFSET_MASK) - 1) == key:
+                # Repeated key: the last row wins, as in ColumnarMetadata.
+                self._slots[slot] = (tag << self._TAG_SHIFT) | (offset + 1)
+                return
+            slot = (slot + 1) & mask
+        self._slots[slot] = (tag << self._TAG_SHIFT) | (offset + 1)
+        self.row_count += 1
+
+    def _grow(self):
+        entries = [entry for entry in self._slots if entry]
+        self._slots = array.array('Q', bytes(16 * len(self._slots)))
+        mask = len(self._slots) - 1
+        for entry in entries:
+            slot, _ = self._place(self._key_at_offset((entry & self._OFFSET_MASK) - 1))
+            while self._slots[slot]:
+                slot = (slot + 1) & mask
+            self._slots[slot] = entry
+
+    def _find(self, key):
+        key = key.encode(self.encoding) if isinstance(key, str) else key
+        slot, tag = self._place(key)
+        mask = len(self._slots) - 1
+        while self._slots[slot]:
+            entry = self._slots[slot]
+            offset = (entry & self._OFFSET_MASK) - 1
+            if entry >> self._TAG_SHIFT == tag and self._key_at_offset(offset) == key:
+                return offset
+            slot = (slot + 1) & mask
+        return None
+
+    def _place(self, key):
+        value = hash(key) & 0xFFFFFFFFFFFFFFFF
+        return value & (len(self._slots) - 1), value >> 48
+
+    def _line_end(self, position):
+        end = self._data.find(b'\n', position)
+        return len(self._data) if end == -1 else end
+
+    def _lines(self, position, count):
+        for _ in range(count):
+            if position >= len(self._data):
+                return
+            end = self._line_end(position)
+            yield self._data[position:end].decode(self.encoding).rstrip('\r')
+            position = end + 1
+
+    def _key_at_offset(self, offset):
+        return self._key_at(offset, self._line_end(offset))
+
+    def _key_at(self, position, end):
+        line = self._data[position:end].rstrip(b'\r')
+        if self.is_jsonl:
+            match = self._key_pattern.search(line)
+            if match:
+                return match.group(1)
+            value = json.loads(line.decode(self.encoding)).get(self.key)
+            return str(value).encode(self.encoding)
+        if line.startswith(b'"'):
+            return next(csv.reader([line.decode(self.encoding)]))[0].encode(self.encoding)
+        comma = line.find(b',')
+        return line if comma == -1 else line[:comma]
+
+
+def infer_column_type(values):
+    """
+    Infers the type of a column from a sample of its values.
+    :param values: strings; empty and missing values are ignored
+    :return: 'int', 'float', 'literal' or 'str'
+    """
+    values = [value for value in values if value]
+    if not values:
+        return 'str'
+    if all(INT_RE.fullmatch(value) for value in values):
+        return 'int'
+    if all(FLOAT_RE.fullmatch(value) for value in values):
+        return 'float'
+    if any(not isinstance(_parse_literal(value), str) for value in values):
+        return 'literal'
+    return 'str'
+
+
+def _infer_column_types(sample, width):
+    return [infer_column_type(values) for values in zip(*sample)] if sample else ['str'] * width
+
+
+class _ColumnBuilder(object):
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.parser = _PARSERS[kind]
+        if kind == 'int':
+            self.values = array.array('q')
+        elif kind == 'float':
+            self.values = array.array('d')
+        else:
+            self.values = []
+
+    def extend(self, raw_values):
+        """Appends converted values and returns the positions of the illegal ones."""
+        if isinstance(self.values, array.array):
+            converted = _convert_numeric(self.kind, raw_values)
+            if converted is not None:
+                self.values.extend(converted)
+                return []
+            # Some value does not fit the array, e.g. an empty cell: keep the column as a list from now on.
+            self.values = list(self.values)
+
+        if self.kind == 'str':
+            # Strings are always legal.
+            self.values.extend(raw_values)
+            return []
+
+        values = list(map(self.parser, raw_values))
+        self.values.extend(values)
+        return [offset for offset, (raw, value) in enumerate(zip(raw_values, values))
+                if raw is not None and not _allowed_parsed_value(value)]
+
+
+def _concatenate(column, values):
+    if isinstance(column, array.array) and isinstance(values, array.array) and column.typecode == values.typecode:
+        column.extend(values)
+        return column
+    column = column if isinstance(column, list) else list(column)
+    column.extend(values)
+    return column
+
+
+def _convert_numeric(kind, raw_values):
+    pattern = INT_RE if kind == 'int' else FLOAT_RE
+    if None in raw_values or not all(map(pattern.fullmatch, raw_values)):
+        return None
+    try:
+        return array.array('q', map(int, raw_values)) if kind == 'int' else array.array('d', map(float, raw_values))
+    except OverflowError:
+        return None
+
+
+def _fit_row(row, width):
+    # Short rows are padded with None, which marks a missing property; extra cells are dropped.
+    if len(row) < width:
+        return row + [None] * (width - len(row))
+    return row[:width]
+
+
+def _split_at_line_breaks(path, count):
+    """Splits the part of the file after the header into up to count byte ranges, each ending at a line break."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.readline()
+        start = f.tell()
+        boundaries = [start]
+        for number in range(1, count):
+            position = max(boundaries[-1], start + (size - start) * number // count)
+            f.seek(position)
+            f.readline()
+            if f.tell() >= size:
+                break
+            boundaries.append(f.tell())
+    boundaries.append(size)
+    return [(begin, end) for begin, end in zip(boundaries, boundaries[1:]) if end > begin]
+
+
+def _load_byte_range(path, byte_range, header, kinds):
+    begin, end = byte_range
+    with open(path, 'rb') as f:
+        f.seek(begin)
+        text = f.read(end - begin).decode(locale.getpreferredencoding(False))
+    report = MetadataReport()
+    metadata = ColumnarMetadata.from_rows(header, csv.reader(io.StringIO(text, newline='')), kinds=kinds,
+                                          report=report, first_row=0)
+    return metadata, report
+
+
+def _parse_literal(value):
+    if value is None:
+        return None
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def _parse_int(value):
+    return int(value) if value is not None and INT_RE.fullmatch(value) else _parse_literal(value)
+
+
+def _parse_float(value):
+    return float(value) if value is not None and FLOAT_RE.fullmatch(value) else _parse_literal(value)
+
+
+_PARSERS = {
+    'int': _parse_int,
+    'float': _parse_float,
+    'literal': _parse_literal,
+    'str': lambda value: value,
+}
 
 
 def properties_allowed(properties, validator):
@@ -104,17 +600,26 @@ def properties_allowed(properties, validator):
 
 
 def allowed_property_key(prop):
-    google_special_properties = ('system:description',
-                                 'system:provider_url',
-                                 'system:tags',
-                                 'system:time_end',
-                                 'system:time_start',
-                                 'system:title')
-
-    if prop in google_special_properties or re.match("^[A-Za-z0-9_]+$", prop):
+    if prop in GOOGLE_SPECIAL_PROPERTIES or PROPERTY_KEY_RE.fullmatch(prop):
         return True
     else:
         logging.warning('Property name %s is invalid. Special properties [system:description, system:provider_url, '
                         'system:tags, system:time_end, system:time_start, system:title] are allowed; other property '
-                        'keys must contain only letters, digits and underscores.')
+                        'keys must contain only letters, digits and underscores.', prop)
         return False
+
+
+def allowed_property_value(value):
+    """
+    A value read from the file is allowed if it turns into a number, a boolean, a string or a list of these, which
+    is what GEE accepts as a property. E.g. 'None', '{1, 2}' or "b'x'" are not allowed.
+    """
+    return _allowed_parsed_value(_parse_literal(value))
+
+
+def _allowed_parsed_value(value):
+    if isinstance(value, (bool, int, float, str)):
+        return True
+    if isinstance(value, list):
+        return all(_allowed_parsed_value(item) for item in value)
+    return False
@@ -0,0 +1,122 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import queue
+import threading
+
+_SENTINEL = object()
+
+
+class Stage(object):
+
+    def __init__(self, name, function, workers=1, queue_size=None):
+        """
+        A single step of a pipeline.
+        :param name: name used in logs and thread names
+        :param function: called with an item; returns the item to pass downstream, or None to drop it
+        :param workers: number of threads running the function
+        :param queue_size: capacity of the input queue; defaults to twice the number of workers
+        """
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.input = queue.Queue(maxsize=queue_size or 2 * self.workers)
+        self.output = None
+        self.threads = []
+
+
+class Pipeline(object):
+
+    def __init__(self, on_error):
+        """
+        Chain of stages joined by bounded queues. Every stage runs on its own threads, so a slow stage only
+        blocks the ones feeding it once its input queue is full.
+        :param on_error: called with (stage name, item, exception) when a stage function raises; the item is dropped
+        """
+        self.stages = []
+        self.on_error = on_error
+        self.aborted = threading.Event()
+        # First exception that is not an Exception, e.g. SystemExit, raised by a stage; re-raised by run().
+        self.fatal = None
+
+    def add_stage(self, name, function, workers=1, queue_size=None):
+        stage = Stage(name, function, workers, queue_size)
+        if self.stages:
+            self.stages[-1].output = stage.input
+        self.stages.append(stage)
+        return stage
+
+    def run(self, items):
+        """
+        Feeds items to the first stage from the calling thread and blocks until every stage has drained. If a stage
+        raised SystemExit, KeyboardInterrupt or similar, the pipeline is aborted and the exception is raised here.
+        :param items: iterable of items; consumed lazily
+        """
+        for stage in self.stages:
+            for number in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(stage,), name='{}-{}'.format(stage.name, number))
+                thread.daemon = True
+                thread.start()
+                stage.threads.append(thread)
+
+        try:
+            for item in items:
+                if self.aborted.is_set():
+                    break
+                self.stages[0].input.put(item)
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            # Stages are closed front to back: once all workers of a stage are gone nothing can be added to the
+            # next queue, so it is safe to send its sentinels.
+            for stage in self.stages:
+                for _ in stage.threads:
+                    stage.input.put(_SENTINEL)
+                for thread in stage.threads:
+                    thread.join()
+
+        if self.fatal is not None:
+            raise self.fatal
+
+    def abort(self):
+        """Stops feeding new items and makes the remaining stages skip whatever is still queued."""
+        self.aborted.set()
+
+    def _work(self, stage):
+        while True:
+            item = stage.input.get()
+            if item is _SENTINEL:
+                return
+            if self.aborted.is_set():
+                continue
+            try:
+                try:
+                    result = stage.function(item)
+                except Exception as e:
+                    self.on_error(stage.name, item, e)
+                    continue
+            except BaseException as e:
+                # The worker keeps taking items off its queue, skipping them, so that nothing blocks on a full queue.
+                if self.fatal is None:
+                    self.fatal = e
+                self.abort()
+                continue
+            if result is not None and stage.output is not None:
+                stage.output.put(result)
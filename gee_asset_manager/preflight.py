@@ -0,0 +1,207 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import collections
+import logging
+import math
+import mmap
+import multiprocessing
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+TiffInfo = collections.namedtuple('TiffInfo', ['path', 'width', 'height', 'bands', 'data_type', 'nodata', 'bigtiff',
+                                               'compression'])
+
+
+class InvalidTiff(Exception):
+    pass
+
+
+class PreflightError(Exception):
+    pass
+
+
+# Field type: (struct format, size in bytes)
+_FIELD_TYPES = {
+    1: ('B', 1),   # BYTE
+    2: ('s', 1),   # ASCII
+    3: ('H', 2),   # SHORT
+    4: ('I', 4),   # LONG
+    5: ('II', 8),  # RATIONAL
+    6: ('b', 1),   # SBYTE
+    7: ('B', 1),   # UNDEFINED
+    8: ('h', 2),   # SSHORT
+    9: ('i', 4),   # SLONG
+    10: ('ii', 8), # SRATIONAL
+    11: ('f', 4),  # FLOAT
+    12: ('d', 8),  # DOUBLE
+    16: ('Q', 8),  # LONG8
+    17: ('q', 8),  # SLONG8
+    18: ('Q', 8),  # IFD8
+}
+
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+GDAL_NODATA = 42113
+
+_SAMPLE_FORMATS = {1: 'uint', 2: 'int', 3: 'float'}
+
+
+def inspect_tiff(path):
+    """
+    Reads the header and the first image file directory of a TIFF or BigTIFF through mmap, without touching the
+    pixel data. Also checks that the image data referenced by the directory lies within the file, which catches
+    truncated uploads and downloads.
+    :param path: path to the file
+    :return: TiffInfo
+    :raises InvalidTiff: if the file is not a readable TIFF
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise InvalidTiff('{} is empty'.format(path))
+        try:
+            return _parse(path, data)
+        except struct.error as e:
+            raise InvalidTiff('{} is truncated or corrupt: {}'.format(path, e))
+        finally:
+            data.close()
+
+
+def _parse(path, data):
+    order = {b'II': '<', b'MM': '>'}.get(data[:2])
+    if order is None:
+        raise InvalidTiff('{} is not a TIFF file'.format(path))
+
+    magic = struct.unpack_from(order + 'H', data, 2)[0]
+    if magic == 42:
+        bigtiff = False
+        ifd_offset = struct.unpack_from(order + 'I', data, 4)[0]
+        count_format, entry_format, entry_size, inline_size = 'H', 'HHI4s', 12, 4
+    elif magic == 43:
+        bigtiff = True
+        ifd_offset = struct.unpack_from(order + 'Q', data, 8)[0]
+        count_format, entry_format, entry_size, inline_size = 'Q', 'HHQ8s', 20, 8
+    else:
+        raise InvalidTiff('{} is not a TIFF file'.format(path))
+
+    if not 0 < ifd_offset < len(data):
+        raise InvalidTiff('{} has no image file directory'.format(path))
+
+    entry_count = struct.unpack_from(order + count_format, data, ifd_offset)[0]
+    position = ifd_offset + struct.calcsize(count_format)
+    tags = {}
+    for _ in range(entry_count):
+        tag, field_type, count, value = struct.unpack_from(order + entry_format, data, position)
+        position += entry_size
+        if field_type not in _FIELD_TYPES:
+            continue
+        value_format, size = _FIELD_TYPES[field_type]
+        if count * size <= inline_size:
+            raw = value[:count * size]
+        else:
+            offset = struct.unpack_from(order + ('Q' if bigtiff else 'I'), value)[0]
+            if offset + count * size > len(data):
+                raise InvalidTiff('{} is truncated: tag {} points past the end of the file'.format(path, tag))
+            raw = data[offset:offset + count * size]
+        if field_type == 2:
+            tags[tag] = raw.split(b'\0', 1)[0].decode('ascii', 'replace')
+        else:
+            tags[tag] = struct.unpack(order + value_format * count, raw)
+
+    for required in (IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE):
+        if required not in tags:
+            raise InvalidTiff('{} lacks required TIFF tag {}'.format(path, required))
+
+    offsets = tags.get(TILE_OFFSETS) or tags.get(STRIP_OFFSETS)
+    byte_counts = tags.get(TILE_BYTE_COUNTS) or tags.get(STRIP_BYTE_COUNTS)
+    if not offsets or not byte_counts:
+        raise InvalidTiff('{} has no image data'.format(path))
+    if max(offset + count for offset, count in zip(offsets, byte_counts)) > len(data):
+        raise InvalidTiff('{} is truncated: image data ends past the end of the file'.format(path))
+
+    bands = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+    bits = tags[BITS_PER_SAMPLE][0]
+    sample_format = _SAMPLE_FORMATS.get(tags.get(SAMPLE_FORMAT, (1,))[0], 'unknown')
+
+    return TiffInfo(path=path,
+                    width=tags[IMAGE_WIDTH][0],
+                    height=tags[IMAGE_LENGTH][0],
+                    bands=bands,
+                    data_type='{}{}'.format(sample_format, bits),
+                    nodata=_parse_nodata(tags.get(GDAL_NODATA)),
+                    bigtiff=bigtiff,
+                    compression=tags.get(COMPRESSION, (1,))[0])
+
+
+def _parse_nodata(value):
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        logging.warning('Cannot read nodata value %r', value)
+        return None
+
+
+def check(info, band_names=None, nodata_value=None):
+    """
+    Decides what to do with an image before it is staged.
+    :param info: TiffInfo
+    :param band_names: (optional) band names requested for the asset
+    :param nodata_value: (optional) nodata value requested for the asset
+    :return: the nodata value to use for the asset: the requested one or, if none was requested, the one in the file
+    :raises PreflightError: if the image cannot be ingested as requested
+    """
+    if band_names and len(band_names) != info.bands:
+        raise PreflightError('{} has {} bands but {} band names were given'.format(info.path, info.bands,
+                                                                                   len(band_names)))
+    if nodata_value is None:
+        if info.nodata is not None and math.isfinite(info.nodata):
+            return info.nodata
+        return None
+    if info.nodata is not None and info.nodata != nodata_value:
+        logging.warning('%s declares nodata value %s; %s will be used instead', info.path, info.nodata, nodata_value)
+    return nodata_value
+
+
+def inspection_pool(workers=None):
+    """
+    Process pool for inspect_tiff. Its processes are started by a fork server, or spawned where there is none, never
+    forked from the caller: the uploader creates the pool while other threads are running, and a process forked then
+    may inherit locks held by those threads.
+    :param workers: (optional) number of processes; defaults to the number of CPUs
+    :return: ProcessPoolExecutor
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
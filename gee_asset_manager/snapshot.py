@@ -0,0 +1,101 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+
+import collections
+import time
+
+from .journal import SQLiteStore
+
+SnapshotEntry = collections.namedtuple('SnapshotEntry', ['asset_id', 'version', 'row'])
+
+
+class ReportSnapshot(SQLiteStore):
+
+    def __init__(self, filename, commit_every=1000):
+        """
+        On-disk copy of the last report, keyed by asset id and holding the version of each asset as listed. An asset
+        whose listed version has not changed can be reported from here without asking Earth Engine again. Every run
+        marks the assets it saw, so the ones not seen since the run began have been deleted.
+        :param filename: path to the SQLite database
+        :param commit_every: number of writes between commits
+        """
+        super(ReportSnapshot, self).__init__(filename, ['CREATE TABLE IF NOT EXISTS assets ('
+                                                        'asset_id TEXT PRIMARY KEY, '
+                                                        'version TEXT, '
+                                                        'type TEXT, '
+                                                        'size REAL, '
+                                                        'time TEXT, '
+                                                        'owners TEXT, '
+                                                        'readers TEXT, '
+                                                        'writers TEXT, '
+                                                        'run INTEGER NOT NULL)',
+                                                        'CREATE INDEX IF NOT EXISTS assets_run ON assets (run)',
+                                                        'CREATE TABLE IF NOT EXISTS runs ('
+                                                        'run INTEGER PRIMARY KEY, '
+                                                        'started REAL NOT NULL)'])
+        self.commit_every = commit_every
+        self._pending_writes = 0
+
+    def begin(self):
+        """Starts a new run and returns its number."""
+        with self._lock, self._connection:
+            return self._connection.execute('INSERT INTO runs (started) VALUES (?)', (time.time(),)).lastrowid
+
+    def get(self, asset_id):
+        with self._lock:
+            row = self._connection.execute('SELECT asset_id, version, type, size, time, owners, readers, writers '
+                                           'FROM assets WHERE asset_id = ?', (asset_id,)).fetchone()
+        return SnapshotEntry(row[0], row[1], _to_report_row(row)) if row else None
+
+    def put(self, version, row, run):
+        """
+        Stores the report row of an asset.
+        :param version: version of the asset as listed; None if unknown, so that the asset is always queried again
+        :param row: report row, i.e. asset id, type, size, time, owners, readers and writers
+        :param run: number of the current run
+        """
+        values = [row[0], version, row[1], None if row[2] == '' else row[2]] + list(row[3:7]) + [run]
+        self._execute('INSERT OR REPLACE INTO assets (asset_id, version, type, size, time, owners, readers, writers, '
+                      'run) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', values)
+
+    def seen(self, asset_id, run):
+        self._execute('UPDATE assets SET run = ? WHERE asset_id = ?', (run, asset_id))
+
+    def remove_unseen(self, run):
+        """Deletes the assets not seen in the given run and returns their last report rows."""
+        with self._lock, self._connection:
+            rows = self._connection.execute('SELECT asset_id, version, type, size, time, owners, readers, writers '
+                                            'FROM assets WHERE run < ?', (run,)).fetchall()
+            self._connection.execute('DELETE FROM assets WHERE run < ?', (run,))
+        return [_to_report_row(row) for row in rows]
+
+    def _execute(self, statement, parameters):
+        # Writes are committed in batches: a crawl stores one row per asset.
+        with self._lock:
+            self._connection.execute(statement, parameters)
+            self._pending_writes += 1
+            if self._pending_writes >= self.commit_every:
+                self._connection.commit()
+                self._pending_writes = 0
+
+
+def _to_report_row(row):
+    asset_id, _, asset_type, size = row[:4]
+    return [asset_id, asset_type, '' if size is None else size] + list(row[4:])
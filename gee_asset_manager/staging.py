@@ -0,0 +1,208 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import base64
+import collections
+import hashlib
+import logging
+import math
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import google.auth
+import google_crc32c
+import requests
+from google.api_core import exceptions
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import storage
+
+Checksums = collections.namedtuple('Checksums', ['md5', 'crc32c'])
+
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+# Limit of a single compose request.
+MAX_COMPOSE_COMPONENTS = 32
+MIN_PART_SIZE = 32 * 1024 * 1024
+# Resumable upload chunks used when a transfer monitor is given. Bytes are counted as they are read, and a chunk is
+# sent as soon as it is read, so progress and rates follow the network rather than the disk. Smaller chunks when the
+# bandwidth is limited let the limiter pace requests evenly. Both must be multiples of 256 KB.
+MONITORED_CHUNK_SIZE = 16 * 256 * 1024
+THROTTLED_CHUNK_SIZE = 4 * 256 * 1024
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def pooled_adapter(pool_size):
+    """HTTP adapter keeping up to pool_size connections open per host, so concurrent workers reuse TLS sessions."""
+    return requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(1, pool_size))
+
+
+def mount_pooled_adapter(session, pool_size):
+    adapter = pooled_adapter(pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def create_storage_client(pool_size):
+    """
+    Storage client whose HTTP transport is shared by all staging workers and sized to their number.
+    :param pool_size: number of connections kept open; should match the number of concurrent uploads
+    :return: google.cloud.storage.Client
+    """
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    session = mount_pooled_adapter(AuthorizedSession(credentials), pool_size)
+    return storage.Client(project=project, credentials=credentials, _http=session)
+
+
+class BucketCache(object):
+
+    def __init__(self, storage_client):
+        """
+        Looks up each bucket once per run instead of once per file. Safe to share between threads.
+        :param storage_client: google.cloud.storage.Client
+        """
+        self.storage_client = storage_client
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket_name):
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = self.storage_client.get_bucket(bucket_name)
+            return self._buckets[bucket_name]
+
+
+def compute_checksums(path):
+    """
+    Computes MD5 and CRC32C of a file in a single read.
+    :param path: path to the file
+    :return: Checksums with both values base64-encoded, as Google Cloud Storage reports them
+    """
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            md5.update(chunk)
+            crc32c.update(chunk)
+    return Checksums(md5=_b64(md5.digest()), crc32c=_b64(crc32c.digest()))
+
+
+def content_addressed_name(path, checksums):
+    """Name of the staged object: the MD5 of the content, so identical files share one object."""
+    md5_hex = base64.b64decode(checksums.md5).hex()
+    return md5_hex + os.path.splitext(path)[1].lower()
+
+
+def stage_file(bucket, path, composite_threshold=None, composite_workers=8, monitor=None):
+    """
+    Uploads a file to a bucket under a content-addressed name, unless an object with the same checksums is
+    already there.
+    :param bucket: google.cloud.storage.Bucket
+    :param path: path to the local file
+    :param composite_threshold: (optional) files larger than this many bytes are uploaded in parallel parts and
+    composed into one object on the server
+    :param composite_workers: (optional) number of parts of a single file uploaded at the same time
+    :param monitor: (optional) TransferMonitor pacing and reporting the upload
+    :return: gs:// URI of the staged object
+    """
+    checksums = compute_checksums(path)
+    blob_name = content_addressed_name(path, checksums)
+    url = 'gs://' + bucket.name + '/' + blob_name
+
+    existing = bucket.get_blob(blob_name)
+    if existing is not None and _matches(existing, checksums):
+        logging.info('%s is already staged as %s', path, url)
+        return url
+
+    size = os.path.getsize(path)
+    if monitor:
+        monitor.file_started(path, size)
+    try:
+        if composite_threshold and size > composite_threshold:
+            _upload_composite(bucket, path, blob_name, size, checksums, composite_workers, monitor)
+        else:
+            blob = bucket.blob(blob_name, chunk_size=_chunk_size(monitor))
+            # Known checksums are sent along with the upload and verified by the server.
+            blob.md5_hash = checksums.md5
+            blob.crc32c = checksums.crc32c
+            with open(path, 'rb') as f:
+                blob.upload_from_file(monitor.wrap(f, path) if monitor else f, size=size, content_type='image/tiff')
+    finally:
+        if monitor:
+            monitor.file_finished(path)
+
+    return url
+
+
+def _upload_composite(bucket, path, blob_name, size, checksums, workers, monitor):
+    part_count = min(MAX_COMPOSE_COMPONENTS, max(2, int(math.ceil(size / float(MIN_PART_SIZE)))))
+    part_size = int(math.ceil(size / float(part_count)))
+    ranges = [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+    # Part names are unique to this upload: another worker may be staging the same content at the same time.
+    upload_id = uuid.uuid4().hex
+    parts = [bucket.blob('{}.part-{}-{:02d}'.format(blob_name, upload_id, number), chunk_size=_chunk_size(monitor))
+             for number in range(len(ranges))]
+    logging.info('Uploading %s in %d parts', path, len(parts))
+
+    def upload_part(part, offset, length):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            part.upload_from_file(monitor.wrap(f, path) if monitor else f, size=length, checksum='crc32c')
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(upload_part, part, offset, length)
+                       for part, (offset, length) in zip(parts, ranges)]
+            for future in futures:
+                future.result()
+
+        blob = bucket.blob(blob_name)
+        blob.compose(parts)
+        blob.reload()
+        if blob.crc32c != checksums.crc32c:
+            blob.delete()
+            raise ChecksumMismatch('Composed object {} does not match {}: CRC32C {} != {}'.format(
+                blob_name, path, blob.crc32c, checksums.crc32c))
+    finally:
+        for part in parts:
+            try:
+                part.delete()
+            except exceptions.NotFound:
+                pass
+
+
+def _chunk_size(monitor):
+    if not monitor:
+        return None
+    return THROTTLED_CHUNK_SIZE if monitor.limiter else MONITORED_CHUNK_SIZE
+
+
+def _matches(blob, checksums):
+    if blob.crc32c != checksums.crc32c:
+        return False
+    # Composite objects have no MD5.
+    return blob.md5_hash is None or blob.md5_hash == checksums.md5
+
+
+def _b64(digest):
+    return base64.b64encode(digest).decode('ascii')
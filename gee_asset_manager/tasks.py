@@ -0,0 +1,438 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import collections
+import fnmatch
+import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ee
+import retrying
+
+from .journal import SQLiteStore, UploadJournal
+from .throughput import TokenBucket
+
+CANCELLABLE_STATES = ('READY', 'RUNNING')
+
+BatchStatistics = collections.namedtuple('BatchStatistics', ['batch', 'ready', 'running', 'completed', 'failed',
+                                                             'assets_per_hour', 'queue_latency', 'run_latency'])
+
+
+def retry_if_ee_error(exception):
+    return isinstance(exception, ee.EEException)
+
+
+class TaskIdAllocator(object):
+
+    def __init__(self, block_size=100):
+        """
+        Hands out task IDs reserved from Earth Engine in blocks, saving one round trip per task. Every call to next()
+        returns an ID that has not been handed out before, so a retried request never reuses the ID of a failed one.
+        Safe to share between threads.
+        :param block_size: number of IDs requested at once
+        """
+        self.block_size = max(1, block_size)
+        self._ids = collections.deque()
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            if not self._ids:
+                self._ids.extend(_new_task_ids(self.block_size))
+                logging.debug('Reserved %d new task IDs', self.block_size)
+            return self._ids.popleft()
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _new_task_ids(count):
+    return ee.data.newTaskId(count)
+
+
+class TaskScheduler(object):
+
+    ACTIVE_STATES = ('UNSUBMITTED', 'READY', 'RUNNING', 'CANCEL_REQUESTED')
+
+    def __init__(self, max_active_tasks=20, on_failed=None, on_completed=None, min_interval=2, max_interval=60,
+                 waiting_interval=10, chunk_size=50, max_unknown_polls=5):
+        """
+        Keeps the number of tasks submitted by this run that are still queued or running below a limit. Only the
+        tasks registered here are polled, in chunks with ee.data.getTaskStatus, by a background thread. The poll
+        interval shrinks to min_interval whenever a task finishes and grows towards max_interval while nothing changes.
+        :param max_active_tasks: number of slots, i.e. tasks allowed to be READY or RUNNING at the same time
+        :param on_failed: called with (task_id, payload, error message) for tasks that failed or were cancelled
+        :param on_completed: called with (task_id, payload) for tasks that completed
+        :param min_interval: shortest time between polls, in seconds
+        :param max_interval: longest time between polls, in seconds
+        :param waiting_interval: longest time between polls while a submission is waiting for a slot
+        :param chunk_size: number of task IDs sent in one getTaskStatus call
+        :param max_unknown_polls: after this many polls reporting UNKNOWN the task is given up on and its slot freed
+        """
+        self.max_active_tasks = max(1, max_active_tasks)
+        self.on_failed = on_failed
+        self.on_completed = on_completed
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.waiting_interval = waiting_interval
+        self.chunk_size = chunk_size
+        self.max_unknown_polls = max_unknown_polls
+        self._active = {}
+        self._unknown_polls = collections.Counter()
+        self._reserved = 0
+        self._waiting = 0
+        self._interval = min_interval
+        self._stop = threading.Event()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._poll_forever, name='task-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def free_slots(self):
+        with self._condition:
+            return self.max_active_tasks - len(self._active) - self._reserved
+
+    def acquire(self):
+        """
+        Blocks until a slot is free and reserves it for the next submission.
+        :raises RuntimeError: if the polling thread died, as no slot would ever be freed
+        """
+        with self._condition:
+            waiting_logged = False
+            while len(self._active) + self._reserved >= self.max_active_tasks:
+                if not self._thread.is_alive():
+                    raise RuntimeError('The task scheduler stopped polling; no task slot will be freed')
+                if not waiting_logged:
+                    logging.info('All %d task slots are taken. Waiting for a task to finish', self.max_active_tasks)
+                    waiting_logged = True
+                self._waiting += 1
+                try:
+                    self._condition.wait(self.waiting_interval)
+                finally:
+                    self._waiting -= 1
+            self._reserved += 1
+
+    def release(self):
+        """Gives back a slot reserved with acquire() when the submission did not happen."""
+        with self._condition:
+            self._reserved -= 1
+            self._condition.notify_all()
+
+    def submitted(self, task_id, payload=None):
+        """Turns a reserved slot into a tracked task."""
+        with self._condition:
+            self._reserved -= 1
+            self._active[task_id] = payload
+            self._condition.notify_all()
+
+    def track(self, task_id, payload=None):
+        """Tracks a task submitted earlier, without a reserved slot; it still counts against the limit."""
+        with self._condition:
+            self._active[task_id] = payload
+            self._condition.notify_all()
+
+    def close(self):
+        """Stops the background thread and reports the state of the tracked tasks one last time."""
+        self._stop.set()
+        self._thread.join()
+        try:
+            self.poll()
+        except Exception as e:
+            logging.warning('Could not fetch the final status of running tasks: %s', e)
+
+    def poll(self):
+        with self._condition:
+            task_ids = list(self._active)
+
+        finished = 0
+        for start in range(0, len(task_ids), self.chunk_size):
+            statuses = ee.data.getTaskStatus(task_ids[start:start + self.chunk_size])
+            for status in statuses:
+                if self._update(status):
+                    finished += 1
+
+        if finished:
+            with self._condition:
+                self._condition.notify_all()
+        return finished
+
+    def _update(self, status):
+        task_id = status.get('id')
+        # A status without a state is treated like one Earth Engine does not know.
+        state = status.get('state', 'UNKNOWN')
+        if task_id is None:
+            return False
+
+        if state in self.ACTIVE_STATES:
+            return False
+
+        if state == 'UNKNOWN':
+            self._unknown_polls[task_id] += 1
+            if self._unknown_polls[task_id] < self.max_unknown_polls:
+                return False
+            logging.warning('Task %s is unknown to Earth Engine. It will no longer be tracked', task_id)
+
+        with self._condition:
+            payload = self._active.pop(task_id, None)
+        self._unknown_polls.pop(task_id, None)
+
+        if state == 'COMPLETED':
+            if self.on_completed:
+                self.on_completed(task_id, payload)
+        elif self.on_failed:
+            self.on_failed(task_id, payload, status.get('error_message', state))
+        return True
+
+    def _poll_forever(self):
+        while not self._stop.wait(self._interval):
+            with self._condition:
+                if not self._active:
+                    self._interval = self.min_interval
+                    continue
+            try:
+                finished = self.poll()
+            except ee.EEException as e:
+                logging.warning('Could not fetch the status of running tasks: %s', e)
+                finished = 0
+            except Exception:
+                # Anything else, e.g. a malformed response or a failing callback, must not stop the polling: tasks
+                # waiting for a slot would block forever.
+                logging.exception('Unexpected error while polling task status')
+                finished = 0
+
+            if finished:
+                self._interval = self.min_interval
+            else:
+                longest = self.waiting_interval if self._waiting else self.max_interval
+                self._interval = min(self._interval * 1.5, longest)
+
+
+def select_tasks(tasks, states=CANCELLABLE_STATES, task_types=None, description=None, submitted_after=None):
+    """
+    Filters tasks as returned by ee.data.getTaskList.
+    :param tasks: iterable of task dictionaries
+    :param states: (optional) accepted states
+    :param task_types: (optional) accepted task types or prefixes of them, e.g. INGEST matches INGEST_IMAGE and
+    INGEST_TABLE; all if not given
+    :param description: (optional) Unix-like pattern the description must match, e.g. '*users/pinkiepie/ponies/*'
+    :param submitted_after: (optional) only tasks created at this time or later, in milliseconds since the epoch
+    :return: list of matching tasks
+    """
+    return [task for task in tasks
+            if task['state'] in states
+            and (not task_types or (task.get('task_type') or '').startswith(tuple(task_types)))
+            and (not description or fnmatch.fnmatchcase(task.get('description', ''), description))
+            and (submitted_after is None or task.get('creation_timestamp_ms', 0) >= submitted_after)]
+
+
+def cancel_tasks(states=CANCELLABLE_STATES, task_types=None, description=None, submitted_after=None, workers=20,
+                 rate=50):
+    """
+    Cancels the tasks of the user matching all the given filters (see select_tasks). Requests are sent by workers
+    threads, at most rate per second altogether.
+    :param workers: (optional) number of concurrent requests
+    :param rate: (optional) number of cancel requests per second
+    :return: Counter with the number of tasks matched, cancelled and failed
+    """
+    tasks = select_tasks(ee.data.getTaskList(), states, task_types, description, submitted_after)
+    counts = collections.Counter(matched=len(tasks))
+    logging.info('Cancelling %d tasks', len(tasks))
+    bucket = TokenBucket(rate)
+
+    def cancel(task):
+        bucket.consume()
+        try:
+            _cancel_task(task['id'])
+        except ee.EEException as e:
+            # Usually the task has finished in the meantime.
+            logging.warning('Task %s could not be cancelled: %s', task['id'], e)
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for cancelled in pool.map(cancel, tasks):
+            counts['cancelled' if cancelled else 'failed'] += 1
+            if counts['cancelled'] and counts['cancelled'] % 1000 == 0:
+                logging.info('Cancelled %d of %d tasks', counts['cancelled'], len(tasks))
+
+    logging.info('Cancelled %d of %d matching tasks', counts['cancelled'], len(tasks))
+    return counts
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _cancel_task(task_id):
+    ee.data.cancelTask(task_id)
+
+
+class TaskCache(SQLiteStore):
+
+    TERMINAL_STATES = ('COMPLETED', 'FAILED', 'CANCELLED', 'UNKNOWN')
+
+    def __init__(self, filename, chunk_size=50):
+        """
+        On-disk copy of the state of tasks. A refresh only asks for the tasks that were not finished at the previous
+        one, plus new IDs found in upload journals; the full task list is downloaded on the first refresh or when
+        asked for. Tasks are grouped into batches by the folder or collection of the asset they ingest, or by task
+        type for other tasks.
+        :param filename: path to the SQLite database
+        :param chunk_size: number of task IDs sent in one getTaskStatus call
+        """
+        super(TaskCache, self).__init__(filename, ['CREATE TABLE IF NOT EXISTS tasks ('
+                                                   'id TEXT PRIMARY KEY, '
+                                                   'state TEXT NOT NULL, '
+                                                   'task_type TEXT, '
+                                                   'description TEXT, '
+                                                   'batch TEXT, '
+                                                   'created_ms INTEGER, '
+                                                   'started_ms INTEGER, '
+                                                   'updated_ms INTEGER, '
+                                                   'error TEXT)',
+                                                   'CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state)'])
+        self.chunk_size = chunk_size
+
+    def refresh(self, full=False, journal_paths=()):
+        """
+        Brings the cache up to date.
+        :param full: (optional) download the whole task list instead of polling unfinished tasks only
+        :param journal_paths: (optional) upload journals whose task IDs are added to the cache
+        :return: number of tasks whose state was fetched
+        """
+        batches = {}
+        for journal_path in journal_paths:
+            journal = UploadJournal(journal_path)
+            try:
+                for task_id, asset_id in journal.task_ids():
+                    batches[task_id] = asset_id.rsplit('/', 1)[0]
+            finally:
+                journal.close()
+
+        cached = {row[0] for row in self._connection.execute('SELECT id FROM tasks')}
+        if full or not cached:
+            statuses = _task_list()
+        else:
+            task_ids = [row[0] for row in self._connection.execute(
+                'SELECT id FROM tasks WHERE state NOT IN ({})'.format(', '.join('?' * len(self.TERMINAL_STATES))),
+                self.TERMINAL_STATES)]
+            task_ids.extend(task_id for task_id in batches if task_id not in cached)
+            statuses = []
+            for start in range(0, len(task_ids), self.chunk_size):
+                statuses.extend(_task_status(task_ids[start:start + self.chunk_size]))
+
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO tasks (id, state, task_type, description, batch, created_ms, started_ms, updated_ms, '
+                'error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                # A status may lack fields the task list had; they keep their cached value, and so does the batch.
+                'ON CONFLICT (id) DO UPDATE SET state = excluded.state, '
+                'task_type = COALESCE(excluded.task_type, task_type), '
+                'description = COALESCE(excluded.description, description), '
+                'batch = COALESCE(batch, excluded.batch), '
+                'created_ms = COALESCE(excluded.created_ms, created_ms), '
+                'started_ms = COALESCE(excluded.started_ms, started_ms), '
+                'updated_ms = COALESCE(excluded.updated_ms, updated_ms), '
+                'error = COALESCE(excluded.error, error)',
+                [(status['id'], status['state'], status.get('task_type'), status.get('description'),
+                  batches.get(status['id']) or _batch_of(status), status.get('creation_timestamp_ms'),
+                  status.get('start_timestamp_ms'), status.get('update_timestamp_ms'), status.get('error_message'))
+                 for status in statuses])
+        logging.info('Fetched the state of %d tasks', len(statuses))
+        return len(statuses)
+
+    def statistics(self):
+        """
+        Returns a BatchStatistics for every batch: the number of tasks waiting, running, completed and failed, the
+        rate at which tasks completed from the first start to the last completion, and the 50th, 95th and 99th
+        percentiles of the time spent queued and running, in seconds.
+        """
+        rows = collections.defaultdict(list)
+        for row in self._connection.execute('SELECT batch, state, created_ms, started_ms, updated_ms FROM tasks'):
+            rows[row[0]].append(row[1:])
+
+        statistics = []
+        for batch in sorted(rows, key=str):
+            states = collections.Counter(state for state, _, _, _ in rows[batch])
+            done = [(created, started, updated) for state, created, started, updated in rows[batch]
+                    if state == 'COMPLETED' and None not in (created, started, updated)]
+            started = [(created, start) for _, created, start, _ in rows[batch]
+                       if created is not None and start is not None]
+            queue_latency = _percentiles([(start - created) / 1000.0 for created, start in started])
+            run_latency = _percentiles([(updated - start) / 1000.0 for _, start, updated in done])
+            if done:
+                hours = (max(updated for _, _, updated in done) - min(start for _, start, _ in done)) / 3600000.0
+                assets_per_hour = len(done) / hours if hours > 0 else None
+            else:
+                assets_per_hour = None
+            statistics.append(BatchStatistics(batch, states['READY'] + states['UNSUBMITTED'], states['RUNNING'],
+                                              states['COMPLETED'], states['FAILED'] + states['CANCELLED'],
+                                              assets_per_hour, queue_latency, run_latency))
+        return statistics
+
+
+def show_tasks(cache_path, journal_paths=(), full=False):
+    """
+    Refreshes the task cache and prints queue depth, throughput and latencies of every batch of tasks.
+    :param cache_path: SQLite file of the TaskCache
+    :param journal_paths: (optional) upload journals with IDs of tasks to follow
+    :param full: (optional) download the whole task list
+    """
+    cache = TaskCache(cache_path)
+    try:
+        cache.refresh(full=full, journal_paths=journal_paths)
+        statistics = cache.statistics()
+    finally:
+        cache.close()
+
+    row_format = '{:<40} {:>7} {:>7} {:>9} {:>7} {:>12} {:>20} {:>20}'
+    print(row_format.format('Batch', 'Ready', 'Running', 'Completed', 'Failed', 'Assets/hour', 'Queue p50/p95/p99 [s]',
+                            'Run p50/p95/p99 [s]'))
+    for batch in statistics:
+        print(row_format.format(batch.batch, batch.ready, batch.running, batch.completed, batch.failed,
+                                '{:.1f}'.format(batch.assets_per_hour) if batch.assets_per_hour is not None else '-',
+                                _format_percentiles(batch.queue_latency), _format_percentiles(batch.run_latency)))
+
+
+def _batch_of(status):
+    # Ingestion tasks are described as "Asset ingestion: users/pinkiepie/collection/image".
+    description = status.get('description') or ''
+    if (status.get('task_type') or '').startswith('INGEST') and ': ' in description:
+        return description.split(': ', 1)[1].rsplit('/', 1)[0]
+    return status.get('task_type')
+
+
+def _percentiles(values, ranks=(50, 95, 99)):
+    """Nearest-rank percentiles; None for an empty list."""
+    if not values:
+        return None
+    values = sorted(values)
+    return tuple(values[max(0, int(math.ceil(rank / 100.0 * len(values))) - 1)] for rank in ranks)
+
+
+def _format_percentiles(percentiles):
+    return '/'.join('{:.0f}'.format(value) for value in percentiles) if percentiles else '-'
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _task_list():
+    return ee.data.getTaskList()
+
+
+@retrying.retry(retry_on_exception=retry_if_ee_error, wait_exponential_multiplier=1000, wait_exponential_max=4000, stop_max_attempt_number=3)
+def _task_status(task_ids):
+    return ee.data.getTaskStatus(task_ids)
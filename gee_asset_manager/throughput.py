@@ -0,0 +1,193 @@
+__copyright__ = """
+
+    Copyright 2016 Lukasz Tracewski
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+
+"""
+__license__ = "Apache 2.0"
+
+import datetime
+import logging
+import threading
+import time
+
+progress_logger = logging.getLogger('gee_asset_manager.progress')
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=None):
+        """
+        Token bucket limiting the average rate of some quantity, e.g. bytes sent. Safe to share between threads.
+        :param rate: tokens added per second
+        :param capacity: (optional) largest burst; defaults to one second worth of tokens
+        """
+        if not rate > 0:
+            raise ValueError('Token bucket rate must be positive, got {}'.format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        """Blocks until the given number of tokens is available and takes them."""
+        while amount > 0:
+            # Requests larger than the bucket are served in pieces, so they are paced rather than refused.
+            piece = min(amount, self.capacity)
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= piece:
+                    self._tokens -= piece
+                    amount -= piece
+                    continue
+                delay = (piece - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class TransferMonitor(object):
+
+    def __init__(self, total_bytes=None, max_bandwidth=None, interval=10):
+        """
+        Paces and reports the bytes sent by all staging workers. Every interval seconds the transfer rate, the ETA and
+        the progress of the files in flight are logged to the gee_asset_manager.progress logger.
+        :param total_bytes: (optional) size of the whole batch, needed for the ETA
+        :param max_bandwidth: (optional) limit in bytes per second shared by all workers, averaged over about a
+        second; bursts of up to one second worth of bytes are allowed
+        :param interval: seconds between reports
+        """
+        self.total_bytes = total_bytes
+        self.limiter = TokenBucket(max_bandwidth) if max_bandwidth else None
+        self.interval = interval
+        self.sent = 0
+        self._files = {}
+        self._started = time.monotonic()
+        self._last_report = self._started
+        self._sent_at_last_report = 0
+        self._lock = threading.Lock()
+
+    def expect(self, size):
+        """Adds to the size of the batch, for batches discovered while they are uploaded."""
+        with self._lock:
+            self.total_bytes = (self.total_bytes or 0) + size
+
+    def file_started(self, path, size):
+        with self._lock:
+            self._files[path] = [0, size]
+
+    def file_finished(self, path):
+        with self._lock:
+            self._files.pop(path, None)
+
+    def wrap(self, stream, path):
+        """File-like object passing reads from the stream through the limiter and the counters."""
+        return MonitoredReader(stream, path, self)
+
+    def transferred(self, path, amount):
+        if self.limiter:
+            self.limiter.consume(amount)
+        with self._lock:
+            self.sent += amount
+            if path in self._files:
+                self._files[path][0] += amount
+            now = time.monotonic()
+            if now - self._last_report < self.interval:
+                return
+            rate = (self.sent - self._sent_at_last_report) / (now - self._last_report)
+            self._last_report = now
+            self._sent_at_last_report = self.sent
+            files = [(name, done, size) for name, (done, size) in self._files.items()]
+        self._report(rate, files)
+
+    def summary(self):
+        elapsed = time.monotonic() - self._started
+        progress_logger.info('Sent %.1f MB in %s (%.2f MB/s on average)', self.sent / 1024**2,
+                             datetime.timedelta(seconds=int(elapsed)), self.sent / 1024**2 / max(elapsed, 1e-6))
+
+    def _report(self, rate, files):
+        if self.total_bytes and rate > 0:
+            eta = datetime.timedelta(seconds=int(max(0, self.total_bytes - self.sent) / rate))
+            progress_logger.info('Sent %.1f of %.1f MB at %.2f MB/s. ETA %s', self.sent / 1024**2,
+                                 self.total_bytes / 1024**2, rate / 1024**2, eta)
+        else:
+            progress_logger.info('Sent %.1f MB at %.2f MB/s', self.sent / 1024**2, rate / 1024**2)
+        for name, done, size in files:
+            progress_logger.info('  %s: %.0f%% of %.1f MB', name, 100.0 * done / size if size else 100.0,
+                                 size / 1024**2)
+
+
+class AssetProgress(object):
+
+    def __init__(self, verb, total=None, interval=10):
+        """
+        Counts the assets processed by an operation such as a copy or a deletion, and logs the counts at most every
+        interval seconds.
+        :param verb: past tense logged before the count, e.g. 'Copied'
+        :param total: (optional) number of assets to process
+        :param interval: seconds between log lines
+        """
+        self.verb = verb
+        self.total = total
+        self.interval = interval
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.time()
+        self._last_log = self.started
+
+    def update(self, succeeded):
+        if succeeded:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        now = time.time()
+        if now - self._last_log >= self.interval:
+            self._last_log = now
+            self.log()
+
+    def log(self):
+        elapsed = max(time.time() - self.started, 1e-3)
+        of_total = ' of {}'.format(self.total) if self.total is not None else ''
+        logging.info('%s %d%s assets (%.1f per second), %d failed, %d skipped', self.verb, self.succeeded, of_total,
+                     self.succeeded / elapsed, self.failed, self.skipped)
+
+
+class MonitoredReader(object):
+
+    def __init__(self, stream, path, monitor):
+        self.stream = stream
+        self.path = path
+        self.monitor = monitor
+        self.name = getattr(stream, 'name', path)
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.monitor.transferred(self.path, len(data))
+        return data
+
+    def seek(self, offset, whence=0):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def __len__(self):
+        # Bytes left to read, as requests and requests_toolbelt expect from a file-like object.
+        position = self.stream.tell()
+        end = self.stream.seek(0, 2)
+        self.stream.seek(position)
+        return end - position
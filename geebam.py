@@ -22,6 +22,8 @@ __license__ = "Apache 2.0"
 import argparse
 import logging
 import os
+import sys
+import time
 
 import ee
 
@@ -30,30 +32,50 @@ from gee_asset_manager.batch_uploader import upload
 from gee_asset_manager.config import setup_logging
 from gee_asset_manager.batch_info import report
 from gee_asset_manager.batch_copy import copy
+from gee_asset_manager.batch_updater import update_properties
+from gee_asset_manager.tasks import CANCELLABLE_STATES, cancel_tasks, show_tasks
 
 
-def cancel_all_running_tasks():
-    logging.info('Attempting to cancel all running tasks')
-    running_tasks = [task for task in ee.data.getTaskList() if task['state'] == 'RUNNING']
-    for task in running_tasks:
-        ee.data.cancelTask(task['id'])
-    logging.info('Cancel all request completed')
+def cancel_tasks_from_parser(args):
+    cancel_tasks(states=args.state or CANCELLABLE_STATES,
+                 task_types=args.type,
+                 description=args.description,
+                 submitted_after=args.submitted_after,
+                 workers=args.workers,
+                 rate=args.rate)
 
 
-def cancel_all_running_tasks_from_parser(args):
-    cancel_all_running_tasks()
+def show_tasks_from_parser(args):
+    journals = args.journal
+    if journals is None:
+        journals = ['upload_journal.sqlite'] if os.path.exists('upload_journal.sqlite') else []
+    show_tasks(args.cache, journal_paths=journals, full=args.refresh)
 
 
 def delete_collection_from_parser(args):
-    delete(args.id)
+    failed = delete(args.id, workers=args.workers)
+    if failed:
+        sys.exit(1)
 
 
 def produce_report(args):
-    report(args.filename)
+    if args.diff and not args.snapshot:
+        logging.error('--diff needs the previous report: pass --snapshot as well')
+        sys.exit(1)
+    report(args.filename, workers=args.workers, acl=not args.no_acl, snapshot_path=args.snapshot, diff_path=args.diff,
+           output_format=args.format, top=args.top)
+
+
+def update_properties_from_parser(args):
+    counts = update_properties(args.metadata, args.dest, workers=args.workers, dry_run=args.dry_run)
+    if counts['failed']:
+        sys.exit(1)
 
 
 def batch_copy(args):
-    copy(args.source, args.dest)
+    failed = copy(args.source, args.dest, workers=args.workers, journal_path=args.journal, resume=args.resume)
+    if failed:
+        sys.exit(1)
 
 
 def upload_from_parser(args):
@@ -67,9 +89,46 @@ def upload_from_parser(args):
            bucket_name=args.bucket,
            band_names=args.bands,
            signal_if_error=args.upload_catch_error,
-           tolerate_assets_already_exist=args.tolerate_assets_already_exist)
+           tolerate_assets_already_exist=args.tolerate_assets_already_exist,
+           workers=args.workers,
+           ingestion_workers=args.ingestion_workers,
+           task_id_block_size=args.task_id_block,
+           max_active_tasks=args.max_tasks,
+           journal_path=args.journal,
+           resume=args.resume,
+           composite_threshold=args.composite_threshold * 1024**2 if args.composite_threshold else None,
+           composite_workers=args.composite_workers,
+           max_bandwidth=args.max_bandwidth * 1024**2 if args.max_bandwidth else None,
+           recursive=args.recursive,
+           include=args.include,
+           exclude=args.exclude,
+           metadata_workers=args.metadata_workers,
+           lazy_metadata=args.lazy_metadata,
+           preflight=not args.skip_preflight,
+           preflight_workers=args.preflight_workers,
+           group_by=args.group_by)
     
 
+def _timestamp_ms(string):
+    """Parses a local date, optionally with time, into milliseconds since the epoch."""
+    for date_format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(time.mktime(time.strptime(string, date_format)) * 1000)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Expected a date such as 2017-01-31 or 2017-01-31T14:30, got {}'.format(string))
+
+
+def _positive_float(string):
+    try:
+        value = float(string)
+    except ValueError:
+        value = 0
+    if not value > 0:
+        raise argparse.ArgumentTypeError('Expected a positive number, got {}'.format(string))
+    return value
+
+
 def _comma_separated_strings(string):
     """Parses an input consisting of comma-separated strings.
        Slightly modified version of: https://pypkg.com/pypi/earthengine-api/f/ee/cli/commands.py
@@ -93,6 +152,7 @@ def main(args=None):
     subparsers = parser.add_subparsers()
     parser_delete = subparsers.add_parser('delete', help='Deletes collection and all items inside. Supports Unix-like wildcards.')
     parser_delete.add_argument('id', help='Full path to asset for deletion. Recursively removes all folders, collections and images.')
+    parser_delete.add_argument('-w', '--workers', type=int, default=10, help='Number of assets deleted concurrently.')
     parser_delete.set_defaults(func=delete_collection_from_parser)
 
     parser_upload = subparsers.add_parser('upload', help='Batch Asset Uploader.')
@@ -101,6 +161,12 @@ def main(args=None):
     required_named.add_argument('--dest', help='Destination. Full path for upload to Google Earth Engine, e.g. users/pinkiepie/myponycollection', required=True)
     optional_named = parser_upload.add_argument_group('Optional named arguments')
     optional_named.add_argument('-m', '--metadata', help='Path to CSV with metadata.')
+    optional_named.add_argument('--metadata-workers', type=int, default=1, help='Number of processes parsing the '
+                                                                                'metadata file. Values must not '
+                                                                                'contain line breaks if more than one.')
+    optional_named.add_argument('--lazy-metadata', action='store_true', help='Index the metadata file (CSV or JSON '
+                                                                             'Lines) and read the row of each image '
+                                                                             'only when it is needed.')
     optional_named.add_argument('--large', action='store_true', help='(Advanced) Use multipart upload. Might help if upload of large '
                                                                      'files is failing on some systems. Might cause other issues.')
     optional_named.add_argument('--nodata', type=int, help='The value to burn into the raster as NoData (missing data)')
@@ -120,20 +186,100 @@ def main(args=None):
         action='store_true',
         help='Return exit 0 when assets already exist')
     optional_named.add_argument('--headless', help='Run the browser in headless mode (i.e. no user interface).', action='store_true')
+    optional_named.add_argument('-w', '--workers', type=int, default=1, help='Number of images staged concurrently.')
+    optional_named.add_argument('--ingestion-workers', type=int, default=1, help='Number of ingestion requests submitted '
+                                                                                 'concurrently.')
+    optional_named.add_argument('--task-id-block', type=int, default=100, help='Number of ingestion task IDs reserved '
+                                                                               'from Earth Engine in a single request.')
+    optional_named.add_argument('--max-tasks', type=int, default=20, help='Number of ingestion tasks of this upload '
+                                                                          'allowed to be queued or running at once.')
+    optional_named.add_argument('--journal', default='upload_journal.sqlite', help='File recording the progress of '
+                                                                                   'every asset of the upload.')
+    optional_named.add_argument('--resume', action='store_true', help='Continue every file from the last step recorded '
+                                                                      'in the journal, without listing the destination.')
+    optional_named.add_argument('--composite-threshold', type=int, help='Size in MB above which a file is uploaded to '
+                                                                        'the bucket in parallel parts and composed '
+                                                                        'into one object.')
+    optional_named.add_argument('--composite-workers', type=int, default=8, help='Number of parts of a single file '
+                                                                                 'uploaded at the same time.')
+    optional_named.add_argument('-r', '--recursive', action='store_true', help='Include images in subdirectories of '
+                                                                           'the source directory.')
+    optional_named.add_argument('--include', action='append', help='Upload only files matching this Unix-like '
+                                                                   'pattern, e.g. "*_B4.tif". Can be repeated.')
+    optional_named.add_argument('--exclude', action='append', help='Skip files matching this Unix-like pattern. Can be '
+                                                                   'repeated.')
+    optional_named.add_argument('--skip-preflight', action='store_true', help='Do not read the headers of the images '
+                                                                              'before staging them.')
+    optional_named.add_argument('--preflight-workers', type=int, help='Number of processes reading image headers. '
+                                                                      'Defaults to the number of CPUs.')
+    optional_named.add_argument('--group-by', help='Regular expression grouping images into one asset. The asset name '
+                                                   'is the first group, or the group named "asset"; a group named '
+                                                   '"band" puts every file in a band of its own, e.g. '
+                                                   '"(?P<asset>.+)_(?P<band>B\\d+)".')
+    optional_named.add_argument('--max-bandwidth', type=float, help='Upload bandwidth limit in MB/s, shared by all '
+                                                                    'workers. This is an average: short bursts may '
+                                                                    'go faster.')
 
     parser_upload.set_defaults(func=upload_from_parser)
 
-    parser_cancel = subparsers.add_parser('cancel', help='Cancel all running tasks')
-    parser_cancel.set_defaults(func=cancel_all_running_tasks_from_parser)
+    parser_cancel = subparsers.add_parser('cancel', help='Cancel tasks, by default all ready and running ones')
+    parser_cancel.set_defaults(func=cancel_tasks_from_parser)
+    parser_cancel.add_argument('--state', action='append', choices=['READY', 'RUNNING'],
+                               help='Cancel tasks in this state. Can be repeated. Defaults to READY and RUNNING.')
+    parser_cancel.add_argument('--type', action='append', help='Cancel tasks whose type starts with this, e.g. '
+                                                               'INGEST for INGEST_IMAGE and INGEST_TABLE, or '
+                                                               'EXPORT_IMAGE. Can be repeated.')
+    parser_cancel.add_argument('--description', help='Cancel tasks whose description matches this Unix-like pattern, '
+                                                     'e.g. "*users/pinkiepie/ponies/*".')
+    parser_cancel.add_argument('--submitted-after', type=_timestamp_ms, help='Cancel tasks submitted at this local '
+                                                                             'time or later, e.g. 2017-01-31T14:30.')
+    parser_cancel.add_argument('-w', '--workers', type=int, default=20, help='Number of concurrent requests.')
+    parser_cancel.add_argument('--rate', type=_positive_float, default=50, help='Largest number of cancel requests per second.')
+
+    parser_tasks = subparsers.add_parser('tasks', help='Show queue depth, throughput and latencies of tasks. Tasks '
+                                                       'submitted since the previous run are only found if they '
+                                                       'are in an upload journal, or with --refresh.')
+    parser_tasks.set_defaults(func=show_tasks_from_parser)
+    parser_tasks.add_argument('--cache', default='tasks.sqlite', help='File keeping the state of tasks between runs.')
+    parser_tasks.add_argument('--journal', action='append', help='Upload journal with tasks to follow. Can be repeated. '
+                                                                 'Defaults to upload_journal.sqlite if it exists.')
+    parser_tasks.add_argument('--refresh', action='store_true', help='Download the whole task list instead of '
+                                                                     'polling unfinished tasks only. Needed to see '
+                                                                     'new tasks that are in no upload journal.')
 
     parser_info = subparsers.add_parser('report', help='Produce summary of all assets.')
     parser_info.set_defaults(func=produce_report)
-    parser_info.add_argument('--filename', help='File name for the output CSV (optional)')
-
-    parser_copy = subparsers.add_parser('copy', help='Batch copy of assets. Helps in migrating assets from Google Maps to GEE')
+    parser_info.add_argument('--filename', help='File name for the output, without extension (optional)')
+    parser_info.add_argument('--format', choices=['csv', 'jsonl', 'parquet'], default='csv',
+                             help='Format of the output file. Parquet needs pyarrow.')
+    parser_info.add_argument('--top', type=int, default=10, help='Number of largest folders and collections listed '
+                                                                 'at the end.')
+    parser_info.add_argument('-w', '--workers', type=int, default=10, help='Number of concurrent requests.')
+    parser_info.add_argument('--no-acl', action='store_true', help='Do not fetch owners, readers and writers of '
+                                                                   'assets.')
+    parser_info.add_argument('--snapshot', help='SQLite file keeping the report between runs. Only assets that changed '
+                                                'since the previous run are queried again.')
+    parser_info.add_argument('--diff', help='CSV file listing the assets added, changed and deleted since the previous '
+                                            'run. Requires --snapshot.')
+
+    parser_copy = subparsers.add_parser('copy', help='Batch copy of assets: a folder or a collection with everything '
+                                                     'inside, or images from Google Maps Engine.')
     parser_copy.set_defaults(func=batch_copy)
-    parser_copy.add_argument('--source', help='File with the following structure: [asset name],[asset id in GME]')
-    parser_copy.add_argument('--dest', help='Full path to the directory or collection in EE')
+    parser_copy.add_argument('--source', help='Full path to the asset in EE, or file with the following structure: '
+                                              '[asset name],[asset id in GME]')
+    parser_copy.add_argument('--dest', help='Full path of the copy in EE, or of the directory or collection for GME '
+                                            'images')
+    parser_copy.add_argument('-w', '--workers', type=int, default=10, help='Number of assets copied at the same time.')
+    parser_copy.add_argument('--journal', default='copy_journal.sqlite', help='File recording every copied asset.')
+    parser_copy.add_argument('--resume', action='store_true', help='Skip the assets the journal records as copied.')
+
+    parser_update = subparsers.add_parser('update-properties', help='Set properties of existing assets from a '
+                                                                     'metadata CSV, sending only values that changed.')
+    parser_update.set_defaults(func=update_properties_from_parser)
+    parser_update.add_argument('-m', '--metadata', required=True, help='Path to CSV with metadata, as for upload.')
+    parser_update.add_argument('--dest', required=True, help='Full path to the folder or collection with the assets.')
+    parser_update.add_argument('-w', '--workers', type=int, default=10, help='Number of concurrent requests.')
+    parser_update.add_argument('--dry-run', action='store_true', help='Only log the properties that would change.')
 
     args = parser.parse_args()
 
@@ -22,9 +22,9 @@ setup(
         'Natural Language :: English',
         'License :: OSI Approved :: Apache Software License',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
         'Operating System :: OS Independent',
         'Topic :: Scientific/Engineering :: GIS',
     ),
@@ -32,7 +32,11 @@ setup(
     author_email='lukasz.tracewski@outlook.com',
     description='Google Earth Engine Batch Assets Manager',
     long_description=readme(),
+    python_requires='>=3.7',
     install_requires=requirements(),
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'geebam=geebam:main',
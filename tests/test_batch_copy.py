@@ -0,0 +1,53 @@
+import csv
+
+import ee
+
+from gee_asset_manager.batch_copy import copy
+
+CLOUD_TYPES = {'Image': 'IMAGE', 'ImageCollection': 'IMAGE_COLLECTION', 'Folder': 'FOLDER'}
+
+
+def test_resumed_copy_skips_copied_assets_and_retries_failed_ones(monkeypatch, tmpdir):
+    assets = {'users/a/src': 'Folder', 'users/a/src/i1': 'Image', 'users/a/src/i2': 'Image',
+              'users/a/src/bad': 'Image', 'users/a/src/c': 'ImageCollection', 'users/a/src/c/i3': 'Image'}
+    refused = {'users/a/src/bad'}
+    copied = []
+    created = []
+
+    def list_assets(params):
+        children = sorted(asset_id for asset_id in assets if asset_id.rsplit('/', 1)[0] == params['parent'])
+        return {'assets': [{'id': asset_id, 'type': CLOUD_TYPES[assets[asset_id]]} for asset_id in children]}
+
+    def copy_asset(source, destination):
+        if source in refused:
+            raise ee.EEException('Permission denied')
+        copied.append(source)
+        assets[destination] = assets[source]
+
+    def create_asset(value, path):
+        created.append(path)
+        assets[path] = value['type']
+
+    monkeypatch.setattr(ee.data, 'getInfo', lambda asset_id: {'id': asset_id, 'type': assets[asset_id]}
+                        if asset_id in assets else None)
+    monkeypatch.setattr(ee.data, 'listAssets', list_assets)
+    monkeypatch.setattr(ee.data, 'copyAsset', copy_asset)
+    monkeypatch.setattr(ee.data, 'createAsset', create_asset)
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    monkeypatch.chdir(tmpdir)
+
+    assert copy('users/a/src', 'users/a/dst', workers=2) == 1
+    assert sorted(copied) == ['users/a/src/c/i3', 'users/a/src/i1', 'users/a/src/i2']
+    assert sorted(created) == ['users/a/dst', 'users/a/dst/c']
+
+    # Still refused: nothing else is copied or created again, and the failure is appended.
+    copied[:] = created[:] = []
+    assert copy('users/a/src', 'users/a/dst', workers=2, resume=True) == 1
+    assert copied == created == []
+    with open('failed_batch_copy.csv') as f:
+        assert [row[:2] for row in csv.reader(f)] == [['users/a/src/bad', 'users/a/dst/bad']] * 2
+
+    refused.clear()
+    assert copy('users/a/src', 'users/a/dst', workers=2, resume=True) == 0
+    assert copied == ['users/a/src/bad']
+    assert created == []
@@ -0,0 +1,131 @@
+import csv
+
+import ee
+import pytest
+
+from gee_asset_manager import batch_info
+
+MB = 1024**2
+CLOUD_TYPES = {'Image': 'IMAGE', 'ImageCollection': 'IMAGE_COLLECTION', 'Folder': 'FOLDER'}
+
+
+class FakeEarthEngine(object):
+    """Asset tree served through stubbed ee.data calls; collections are sized by stubbed ee.Dictionary requests."""
+
+    def __init__(self, monkeypatch):
+        # Asset id -> [type, update time, size in bytes]
+        self.assets = {}
+        self.unreadable_collections = set()
+        self.described = []
+        self.size_requests = []
+        monkeypatch.setattr(ee, 'Initialize', lambda *args, **kwargs: None)
+        monkeypatch.setattr(ee.data, 'getAssetRoots', lambda: [{'id': 'users/a', 'type': 'Folder'}])
+        monkeypatch.setattr(ee.data, 'listAssets', self.list_assets)
+        monkeypatch.setattr(ee.data, 'getInfo', self.get_info)
+        monkeypatch.setattr(ee, 'ImageCollection', lambda collection_id: FakeCollection(collection_id))
+        monkeypatch.setattr(ee, 'Dictionary', lambda sums: FakeSizes(self, sums))
+        monkeypatch.setattr('time.sleep', lambda seconds: None)
+
+    def add(self, asset_id, asset_type, size=None, version=1):
+        self.assets[asset_id] = [asset_type, version, size]
+
+    def list_assets(self, params):
+        children = sorted(asset_id for asset_id in self.assets if asset_id.rsplit('/', 1)[0] == params['parent'])
+        return {'assets': [{'id': asset_id, 'type': CLOUD_TYPES[self.assets[asset_id][0]],
+                            'updateTime': str(self.assets[asset_id][1])} for asset_id in children]}
+
+    def get_info(self, asset_id):
+        self.described.append(asset_id)
+        asset_type, version, size = self.assets[asset_id]
+        info = {'id': asset_id, 'type': asset_type, 'version': 1500000000 * 10**6, 'properties': {}}
+        if size is not None:
+            info['properties']['system:asset_size'] = size
+        return info
+
+
+class FakeCollection(object):
+
+    def __init__(self, collection_id):
+        self.collection_id = collection_id
+
+    def aggregate_sum(self, name):
+        return self.collection_id
+
+
+class FakeSizes(object):
+
+    def __init__(self, fake, sums):
+        self.fake = fake
+        self.collection_ids = list(sums)
+
+    def getInfo(self):
+        self.fake.size_requests.append(sorted(self.collection_ids))
+        if self.fake.unreadable_collections.intersection(self.collection_ids):
+            raise ee.EEException('Collection not readable')
+        return {collection_id: self.fake.assets[collection_id][2] for collection_id in self.collection_ids}
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeEarthEngine(monkeypatch)
+    fake.add('users/a/f', 'Folder')
+    fake.add('users/a/f/g', 'Folder')
+    fake.add('users/a/f/g/image3', 'Image', 3 * MB)
+    fake.add('users/a/f/image2', 'Image', 2 * MB)
+    fake.add('users/a/empty', 'Folder')
+    fake.add('users/a/image1', 'Image', 1 * MB)
+    fake.add('users/a/c1', 'ImageCollection', 4 * MB)
+    fake.add('users/a/c2', 'ImageCollection', 5 * MB)
+    fake.add('users/a/bad', 'ImageCollection')
+    fake.unreadable_collections.add('users/a/bad')
+    return fake
+
+
+def read_report(path):
+    with open(path) as f:
+        rows = list(csv.reader(f))[1:]
+    return [row[0] for row in rows], {row[0]: (float(row[2]) if row[2] else None) for row in rows}
+
+
+def read_changes(path):
+    with open(path) as f:
+        return sorted((row[0], row[1]) for row in list(csv.reader(f))[1:])
+
+
+def test_report_sums_folders_after_their_content(fake, tmpdir):
+    output = str(tmpdir.join('report'))
+    batch_info.report(output, workers=2, acl=False, size_batch=3)
+    order, sizes = read_report(output + '.csv')
+
+    assert sizes == {'users/a/f': 5.0, 'users/a/f/g': 3.0, 'users/a/f/g/image3': 3.0, 'users/a/f/image2': 2.0,
+                     'users/a/empty': 0.0, 'users/a/image1': 1.0, 'users/a/c1': 4.0, 'users/a/c2': 5.0,
+                     'users/a/bad': None}
+    assert order.index('users/a/f/g/image3') < order.index('users/a/f/g') < order.index('users/a/f')
+    assert order.index('users/a/f/image2') < order.index('users/a/f')
+    # The batch kept failing because of one collection, so every collection was then asked for on its own.
+    assert fake.size_requests[:3] == [['users/a/bad', 'users/a/c1', 'users/a/c2']] * 3
+    assert sorted(fake.size_requests[3:]) == [['users/a/bad']] * 3 + [['users/a/c1'], ['users/a/c2']]
+
+
+def test_report_reuses_snapshot_and_writes_differences(fake, tmpdir):
+    output = str(tmpdir.join('report'))
+    snapshot = str(tmpdir.join('snapshot.sqlite'))
+    diff = str(tmpdir.join('diff.csv'))
+    batch_info.report(output, workers=2, acl=False, snapshot_path=snapshot, diff_path=diff, size_batch=3)
+    assert len(read_changes(diff)) == 9
+    assert all(change == 'added' for change, _ in read_changes(diff))
+
+    fake.described = []
+    fake.add('users/a/image1', 'Image', 1.5 * MB, version=2)
+    del fake.assets['users/a/f/image2']
+    fake.add('users/a/new', 'Image', 1 * MB)
+    batch_info.report(output, workers=2, acl=False, snapshot_path=snapshot, diff_path=diff, size_batch=3)
+
+    # Only the assets that are new or whose version changed were described again.
+    assert sorted(fake.described) == ['users/a/image1', 'users/a/new']
+    assert read_changes(diff) == [('added', 'users/a/new'), ('changed', 'users/a/f'), ('changed', 'users/a/image1'),
+                                  ('deleted', 'users/a/f/image2')]
+    _, sizes = read_report(output + '.csv')
+    assert sizes['users/a/f'] == 3.0
+    assert sizes['users/a/image1'] == 1.5
+    assert 'users/a/f/image2' not in sizes
@@ -0,0 +1,50 @@
+import os
+import re
+
+from gee_asset_manager.discovery import ImageGroup, discover_images, group_images
+
+
+def make_tree(tmpdir, names):
+    for name in names:
+        tmpdir.join(name).ensure()
+    return str(tmpdir)
+
+
+def relative(paths, root):
+    return sorted(os.path.relpath(path, root) for path in paths)
+
+
+def test_discover_images(tmpdir):
+    root = make_tree(tmpdir, ['a.tif', 'b.TIF', 'c.tiff', 'notes.txt', 'tif',
+                              '2019-01/d.tif', '2019-01/deeper/e.Tiff', '2019-02/f_B4.tif'])
+    assert relative(discover_images(root), root) == ['a.tif', 'b.TIF', 'c.tiff']
+    assert relative(discover_images(root, recursive=True), root) == [
+        '2019-01/d.tif', '2019-01/deeper/e.Tiff', '2019-02/f_B4.tif', 'a.tif', 'b.TIF', 'c.tiff']
+
+
+def test_discover_images_include_exclude(tmpdir):
+    root = make_tree(tmpdir, ['a_B4.tif', 'a_B5.tif', '2019-01/b_B4.tif', '2019-01/b_B5.tif', '2019-02/c_B4.tif'])
+    # Patterns match the file name...
+    assert relative(discover_images(root, recursive=True, include=['*_B4.tif']), root) == [
+        '2019-01/b_B4.tif', '2019-02/c_B4.tif', 'a_B4.tif']
+    # ...or the path relative to the source directory.
+    assert relative(discover_images(root, recursive=True, include=['2019-01/*']), root) == [
+        '2019-01/b_B4.tif', '2019-01/b_B5.tif']
+    assert relative(discover_images(root, recursive=True, exclude=['2019-*/*', '*_B5.tif']), root) == ['a_B4.tif']
+    assert relative(discover_images(root, recursive=True, include=['*_B4.tif'], exclude=['2019-02/*']), root) == [
+        '2019-01/b_B4.tif', 'a_B4.tif']
+
+
+def test_group_images_mosaic():
+    paths = ['/d/scene1_tile01.tif', '/d/scene2_tile01.tif', '/d/scene1_tile02.tif', '/d/other.tif']
+    groups = group_images(paths, re.compile(r'(.+)_tile\d+'))
+    assert groups == [ImageGroup('scene1', ['/d/scene1_tile01.tif', '/d/scene1_tile02.tif'], None),
+                      ImageGroup('scene2', ['/d/scene2_tile01.tif'], None),
+                      ImageGroup('other', ['/d/other.tif'], None)]
+
+
+def test_group_images_bands():
+    paths = ['/d/scene1_B2.tif', '/d/scene1_B1.TIF', '/d/other.tif']
+    groups = group_images(paths, re.compile(r'(?P<asset>.+)_(?P<band>B\d+)'))
+    assert groups == [ImageGroup('scene1', ['/d/scene1_B2.tif', '/d/scene1_B1.TIF'], ['B2', 'B1']),
+                      ImageGroup('other', ['/d/other.tif'], None)]
@@ -0,0 +1,49 @@
+from gee_asset_manager.journal import CopyJournal, UploadJournal
+
+
+def test_upload_journal_keeps_steps_between_runs(tmpdir):
+    path = str(tmpdir.join('journal.sqlite'))
+    journal = UploadJournal(path)
+    assert journal.get('/data/a.tif', 'users/a/a') is None
+    journal.staged('/data/a.tif', 'users/a/a', 'gs://bucket/a')
+    journal.staged('/data/b.tif', 'users/a/b', 'gs://bucket/b')
+    journal.submitted('/data/b.tif', 'users/a/b', 'TASK_B')
+    journal.close()
+
+    journal = UploadJournal(path)
+    a = journal.get('/data/a.tif', 'users/a/a')
+    assert (a.state, a.gsid, a.task_id) == (UploadJournal.STAGED, 'gs://bucket/a', None)
+    b = journal.get('/data/b.tif', 'users/a/b')
+    assert (b.state, b.gsid, b.task_id) == (UploadJournal.SUBMITTED, 'gs://bucket/b', 'TASK_B')
+    assert journal.task_ids() == [('TASK_B', 'users/a/b')]
+    journal.close()
+
+
+def test_upload_journal_state_changes_keep_other_columns(tmpdir):
+    journal = UploadJournal(str(tmpdir.join('journal.sqlite')))
+    journal.staged('/data/a.tif', 'users/a/a', 'gs://bucket/a')
+    journal.submitted('/data/a.tif', 'users/a/a', 'TASK_A')
+    journal.failed('/data/a.tif', 'users/a/a', 'Ingestion failed')
+    entry = journal.get('/data/a.tif', 'users/a/a')
+    assert entry.state == UploadJournal.FAILED
+    assert entry.gsid == 'gs://bucket/a'
+    assert entry.task_id == 'TASK_A'
+    assert entry.error == 'Ingestion failed'
+
+    # Staging again starts a new attempt: the old task is forgotten.
+    journal.staged('/data/a.tif', 'users/a/a', 'gs://bucket/a2')
+    entry = journal.get('/data/a.tif', 'users/a/a')
+    assert (entry.state, entry.gsid, entry.task_id) == (UploadJournal.STAGED, 'gs://bucket/a2', None)
+    journal.completed('/data/a.tif', 'users/a/a')
+    assert journal.get('/data/a.tif', 'users/a/a').state == UploadJournal.COMPLETED
+    journal.close()
+
+
+def test_copy_journal_records_copied_assets(tmpdir):
+    journal = CopyJournal(str(tmpdir.join('copy.sqlite')))
+    journal.copied('users/a/image', 'users/b/image')
+    journal.failed('users/a/other', 'users/b/other', 'Permission denied')
+    assert journal.is_copied('users/a/image', 'users/b/image')
+    assert not journal.is_copied('users/a/image', 'users/c/image')
+    assert not journal.is_copied('users/a/other', 'users/b/other')
+    journal.close()
@@ -0,0 +1,57 @@
+import ee
+
+from gee_asset_manager.listing import AssetNameIndex, iter_children, walk
+
+
+def test_iter_children_follows_pages_and_converts_types(monkeypatch):
+    pages = {
+        None: {'assets': [{'name': 'projects/earthengine-legacy/assets/users/a/image', 'type': 'IMAGE'},
+                          {'name': 'projects/earthengine-legacy/assets/users/a/folder', 'type': 'FOLDER'}],
+               'nextPageToken': 'second'},
+        'second': {'assets': [{'id': 'users/a/collection', 'type': 'IMAGE_COLLECTION'},
+                              {'id': 'users/a/table', 'type': 'TABLE'}]},
+    }
+    requests = []
+
+    def list_assets(params):
+        requests.append(dict(params))
+        return pages[params.get('pageToken')]
+
+    monkeypatch.setattr(ee.data, 'listAssets', list_assets)
+    children = list(iter_children('users/a', page_size=2))
+    assert [(child['id'], child['type']) for child in children] == [
+        ('users/a/image', 'Image'), ('users/a/folder', ee.data.ASSET_TYPE_FOLDER),
+        ('users/a/collection', ee.data.ASSET_TYPE_IMAGE_COLL), ('users/a/table', 'Table')]
+    assert requests == [{'parent': 'users/a', 'pageSize': 2},
+                        {'parent': 'users/a', 'pageSize': 2, 'pageToken': 'second'}]
+
+
+def test_asset_name_index():
+    names = ['image_{}'.format(n) for n in range(1000, 0, -3)] + ['żółw', '', 'image_1']
+    index = AssetNameIndex(iter(names))
+    assert len(index) == len(set(names))
+    assert all(name in index for name in names)
+    assert 'image_2' not in index
+    assert 'image' not in index
+    assert 'żółw2' not in index
+    assert 'anything' not in AssetNameIndex([])
+
+
+def test_walk_skips_containers_that_cannot_be_listed(monkeypatch):
+    tree = {'users/a': [('users/a/f', 'FOLDER'), ('users/a/locked', 'FOLDER')],
+            'users/a/f': [('users/a/f/image', 'IMAGE')]}
+
+    def list_assets(params):
+        if params['parent'] not in tree:
+            raise ee.EEException('Permission denied')
+        return {'assets': [{'id': asset_id, 'type': asset_type} for asset_id, asset_type in tree[params['parent']]]}
+
+    monkeypatch.setattr(ee.data, 'listAssets', list_assets)
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    listed = {}
+    errors = []
+    assets = walk(['users/a'], workers=2, on_listed=lambda parent, children: listed.update({parent: len(children)}),
+                  on_error=lambda parent, error: errors.append(parent))
+    assert sorted(asset['id'] for asset in assets) == ['users/a/f', 'users/a/f/image', 'users/a/locked']
+    assert errors == ['users/a/locked']
+    assert listed == {'users/a': 2, 'users/a/f': 1, 'users/a/locked': 0}
@@ -0,0 +1,95 @@
+import os
+
+from gee_asset_manager.metadata_loader import (ColumnarMetadata, IndexedMetadata, MetadataError, MetadataReport,
+                                             allowed_property_value, infer_column_type, iter_metadata_chunks,
+                                             load_and_validate_metadata, load_metadata_from_csv)
+
+METADATA_PATH = os.path.join(os.path.dirname(__file__), 'images', 'metadata.csv')
+
+
+def test_load_metadata_from_csv():
+    metadata = load_metadata_from_csv(METADATA_PATH)
+    assert len(metadata) == 15
+    assert '4' in metadata
+    assert '5' not in metadata
+    assert metadata['4'] == {'id_no': 4,
+                             'class': 'GASTROPODA',
+                             'category': 'EN',
+                             'binomial': 'Aaadonta constricta',
+                             'system:time_start': 1478640090000}
+
+
+def test_iter_metadata_chunks():
+    chunks = list(iter_metadata_chunks(METADATA_PATH, chunk_size=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 4, 3]
+    metadata = load_metadata_from_csv(METADATA_PATH)
+    for chunk in chunks:
+        for key in chunk:
+            assert chunk[key] == metadata[key]
+
+
+def test_infer_column_type():
+    assert infer_column_type(['1', '-2', '']) == 'int'
+    assert infer_column_type(['1.5', '2', '1e3']) == 'float'
+    assert infer_column_type(['007', '1']) == 'literal'
+    assert infer_column_type(['007', '0042']) == 'str'
+    assert infer_column_type(['[1, 2]', 'abc']) == 'literal'
+    assert infer_column_type(['abc', 'Aaadonta constricta']) == 'str'
+
+
+def test_values_not_matching_column_type():
+    metadata = ColumnarMetadata.from_rows(['key', 'value', 'other'], [['a', '1', 'x'],
+                                                                      ['b', ''],
+                                                                      ['c', 'True', 'y', 'ignored']])
+    assert metadata['a'] == {'key': 'a', 'value': 1, 'other': 'x'}
+    assert metadata['b'] == {'key': 'b', 'value': ''}
+    assert metadata['c'] == {'key': 'c', 'value': True, 'other': 'y'}
+
+
+def test_load_and_validate_metadata_reports_positions(tmpdir):
+    path = tmpdir.join('metadata.csv')
+    path.write('id_no,values\n1,"[1, 2]"\n2,None\n1,[3]\n')
+    metadata, report = load_and_validate_metadata(str(path))
+    assert not report.success
+    assert sorted(report.errors) == [MetadataError(3, 'values', "Illegal value 'None'"),
+                             MetadataError(4, 'id_no', 'Duplicate key 1; the last row is used')]
+    assert metadata['1'] == {'id_no': 1, 'values': [3]}
+
+
+def test_illegal_header():
+    report = MetadataReport()
+    report.check_header(['id_no', 'system:time_start', 'bad name'])
+    assert report.has_header_errors
+    assert report.errors == [MetadataError(1, 'bad name', 'Illegal property name')]
+
+
+def test_allowed_property_value():
+    assert allowed_property_value('12')
+    assert allowed_property_value('Aaadonta constricta')
+    assert allowed_property_value('[1, "a"]')
+    assert not allowed_property_value('None')
+    assert not allowed_property_value('{1, 2}')
+
+
+def test_indexed_metadata_matches_loaded_metadata():
+    loaded = load_metadata_from_csv(METADATA_PATH)
+    indexed = IndexedMetadata(METADATA_PATH)
+    try:
+        assert len(indexed) == len(loaded)
+        assert '5' not in indexed
+        for key in loaded:
+            assert indexed[key] == loaded[key]
+    finally:
+        indexed.close()
+
+
+def test_indexed_metadata_jsonl(tmpdir):
+    path = tmpdir.join('metadata.jsonl')
+    path.write('{"id_no": "my_file_1", "category": "EN"}\n{"id_no": 2, "category": "CR"}\n')
+    indexed = IndexedMetadata(str(path))
+    try:
+        assert indexed['my_file_1'] == {'id_no': 'my_file_1', 'category': 'EN'}
+        assert indexed['2'] == {'id_no': 2, 'category': 'CR'}
+        assert 'my_file_3' not in indexed
+    finally:
+        indexed.close()
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+from gee_asset_manager.pipeline import Pipeline
+
+
+def test_items_flow_through_stages():
+    results = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            results.append(item)
+
+    pipeline = Pipeline(on_error=lambda *args: None)
+    pipeline.add_stage('double', lambda x: 2 * x, workers=3, queue_size=2)
+    pipeline.add_stage('collect', collect, workers=2, queue_size=2)
+    pipeline.run(range(100))
+    assert sorted(results) == [2 * x for x in range(100)]
+
+
+def test_failed_items_go_to_on_error_and_are_dropped():
+    errors = []
+    results = []
+
+    def check(item):
+        if item % 3 == 0:
+            raise ValueError(item)
+        return item
+
+    pipeline = Pipeline(on_error=lambda stage, item, e: errors.append((stage, item, str(e))))
+    pipeline.add_stage('check', check)
+    pipeline.add_stage('collect', results.append)
+    pipeline.run(range(10))
+    assert errors == [('check', x, str(x)) for x in (0, 3, 6, 9)]
+    assert results == [1, 2, 4, 5, 7, 8]
+
+
+def test_bounded_queue_limits_items_in_flight():
+    release = threading.Event()
+    fed = []
+
+    def items():
+        for x in range(20):
+            fed.append(x)
+            yield x
+
+    pipeline = Pipeline(on_error=lambda *args: None)
+    pipeline.add_stage('slow', lambda x: release.wait(), workers=1, queue_size=2)
+    thread = threading.Thread(target=pipeline.run, args=(items(),))
+    thread.start()
+    thread.join(0.5)
+    # One item being processed, two queued and one waiting to be put.
+    assert len(fed) <= 4
+    release.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert len(fed) == 20
+
+
+def test_system_exit_in_stage_aborts_and_is_raised():
+    processed = []
+
+    def stage(item):
+        if item == 5:
+            raise SystemExit(1)
+        processed.append(item)
+
+    pipeline = Pipeline(on_error=lambda *args: None)
+    pipeline.add_stage('exit', stage, workers=1, queue_size=1)
+    with pytest.raises(SystemExit):
+        pipeline.run(range(1000))
+    assert pipeline.aborted.is_set()
+    assert processed == list(range(5))
@@ -0,0 +1,91 @@
+import glob
+import os
+import struct
+
+import pytest
+
+from gee_asset_manager.preflight import InvalidTiff, PreflightError, TiffInfo, check, inspect_tiff, inspection_pool
+
+IMAGES_PATH = os.path.join(os.path.dirname(__file__), 'images')
+
+
+def write_tiff(path, bands, bits, sample_format, nodata=None, bigtiff=False):
+    """Writes a 2x2 uncompressed TIFF or BigTIFF with a single strip."""
+    pixels = b'\0' * (4 * bands * bits // 8)
+    value_format, inline_size, header_size = ('<Q', 8, 16) if bigtiff else ('<I', 4, 8)
+    entry_format, count_format = ('<HHQ8s', '<Q') if bigtiff else ('<HHI4s', '<H')
+    entries = [(256, 3, 1, 2), (257, 3, 1, 2), (258, 3, 1, bits), (259, 3, 1, 1), (273, 4, 1, header_size),
+               (277, 3, 1, bands), (279, 4, 1, len(pixels)), (339, 3, 1, sample_format)]
+    entries = [(tag, field_type, count, struct.pack('<H' if field_type == 3 else '<I', value).ljust(inline_size, b'\0'))
+               for tag, field_type, count, value in entries]
+    ifd_offset = header_size + len(pixels)
+    entry_count = len(entries) + (1 if nodata is not None else 0)
+    extra_offset = (ifd_offset + struct.calcsize(count_format) + struct.calcsize(entry_format) * entry_count +
+                    inline_size)
+    extra = b''
+    if nodata is not None:
+        nodata_bytes = nodata.encode('ascii') + b'\0'
+        if len(nodata_bytes) <= inline_size:
+            value = nodata_bytes.ljust(inline_size, b'\0')
+        else:
+            value, extra = struct.pack(value_format, extra_offset), nodata_bytes
+        entries.append((42113, 2, len(nodata_bytes), value))
+
+    with open(path, 'wb') as f:
+        if bigtiff:
+            f.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, ifd_offset))
+        else:
+            f.write(b'II' + struct.pack('<HI', 42, ifd_offset))
+        f.write(pixels)
+        f.write(struct.pack(count_format, len(entries)))
+        for entry in entries:
+            f.write(struct.pack(entry_format, *entry))
+        f.write(b'\0' * inline_size)
+        f.write(extra)
+
+
+def test_inspect_fixtures():
+    for path in glob.glob(os.path.join(IMAGES_PATH, '*.tif')):
+        info = inspect_tiff(path)
+        assert info.bands == 1
+        assert not info.bigtiff
+    info = inspect_tiff(os.path.join(IMAGES_PATH, '6.tif'))
+    assert (info.width, info.height, info.nodata) == (7, 10, None)
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+@pytest.mark.parametrize('nodata, expected', [('-9999', -9999), ('-3.4028234663852886e+38', -3.4028234663852886e+38)])
+def test_inspect_tags(tmpdir, bigtiff, nodata, expected):
+    path = str(tmpdir.join('multiband.tif'))
+    write_tiff(path, bands=3, bits=16, sample_format=2, nodata=nodata, bigtiff=bigtiff)
+    info = inspect_tiff(path)
+    assert info == TiffInfo(path=path, width=2, height=2, bands=3, data_type='int16', nodata=expected, bigtiff=bigtiff,
+                            compression=1)
+
+
+def test_inspect_invalid_files(tmpdir):
+    not_tiff = tmpdir.join('metadata.tif')
+    not_tiff.write('id_no,class\n')
+    with pytest.raises(InvalidTiff):
+        inspect_tiff(str(not_tiff))
+
+    with open(os.path.join(IMAGES_PATH, '263.tif'), 'rb') as f:
+        content = f.read()
+    truncated = tmpdir.join('truncated.tif')
+    truncated.write_binary(content[:len(content) // 2])
+    with pytest.raises(InvalidTiff):
+        inspect_tiff(str(truncated))
+
+    with inspection_pool(1) as pool:
+        assert pool.submit(inspect_tiff, os.path.join(IMAGES_PATH, '4.tif')).result().width == 39
+        with pytest.raises(InvalidTiff):
+            pool.submit(inspect_tiff, str(not_tiff)).result()
+
+
+def test_check():
+    info = TiffInfo(path='a.tif', width=2, height=2, bands=3, data_type='int16', nodata=-9999, bigtiff=False,
+                    compression=1)
+    assert check(info) == -9999
+    assert check(info, band_names=['r', 'g', 'b'], nodata_value=0) == 0
+    with pytest.raises(PreflightError):
+        check(info, band_names=['r', 'g'])
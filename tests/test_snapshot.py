@@ -0,0 +1,20 @@
+from gee_asset_manager.snapshot import ReportSnapshot
+
+
+def test_snapshot_keeps_rows_between_runs(tmpdir):
+    path = str(tmpdir.join('report.sqlite'))
+    snapshot = ReportSnapshot(path)
+    run = snapshot.begin()
+    snapshot.put('v1', ['users/a/image', 'Image', 1.5, '2020-01-01 00:00:00', 'a', '', ''], run)
+    snapshot.put('v1', ['users/a/folder', 'Folder', '', '2020-01-01 00:00:00', 'a', 'b', ''], run)
+    snapshot.close()
+
+    snapshot = ReportSnapshot(path)
+    run = snapshot.begin()
+    entry = snapshot.get('users/a/folder')
+    assert entry.version == 'v1'
+    assert entry.row == ['users/a/folder', 'Folder', '', '2020-01-01 00:00:00', 'a', 'b', '']
+    snapshot.seen('users/a/folder', run)
+    assert snapshot.remove_unseen(run) == [['users/a/image', 'Image', 1.5, '2020-01-01 00:00:00', 'a', '', '']]
+    assert snapshot.get('users/a/image') is None
+    snapshot.close()
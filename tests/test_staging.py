@@ -0,0 +1,129 @@
+import base64
+import hashlib
+
+import google_crc32c
+import requests
+
+from gee_asset_manager.staging import (BucketCache, compute_checksums, content_addressed_name, mount_pooled_adapter,
+                                       stage_file)
+
+
+def b64(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+
+class FakeBlob(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.data = None
+        self.md5_hash = None
+        self.crc32c = None
+
+    def upload_from_file(self, f, size=None, **kwargs):
+        self.data = f.read(size)
+        self.bucket.uploads.append(self.name)
+        self.bucket.blobs[self.name] = self
+        if self.crc32c is None:
+            self.crc32c = b64(google_crc32c.Checksum(self.data).digest())
+        if self.md5_hash is None:
+            self.md5_hash = b64(hashlib.md5(self.data).digest())
+
+    def compose(self, parts):
+        self.data = b''.join(part.data for part in parts)
+        self.crc32c = b64(google_crc32c.Checksum(self.data).digest())
+        self.bucket.blobs[self.name] = self
+
+    def reload(self):
+        pass
+
+    def delete(self):
+        self.bucket.blobs.pop(self.name, None)
+
+
+class FakeBucket(object):
+
+    def __init__(self, name='bucket'):
+        self.name = name
+        self.blobs = {}
+        self.uploads = []
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self, name)
+
+
+def test_compute_checksums(tmpdir):
+    content = b'GeoTIFF' * 100000
+    path = tmpdir.join('image.TIF')
+    path.write_binary(content)
+    checksums = compute_checksums(str(path))
+    assert checksums.md5 == b64(hashlib.md5(content).digest())
+    assert checksums.crc32c == b64(google_crc32c.Checksum(content).digest())
+    assert content_addressed_name(str(path), checksums) == hashlib.md5(content).hexdigest() + '.tif'
+
+
+def test_stage_file_uploads_once_per_content(tmpdir):
+    bucket = FakeBucket()
+    first = tmpdir.join('a.tif')
+    first.write_binary(b'same content')
+    second = tmpdir.join('b.tif')
+    second.write_binary(b'same content')
+
+    url = stage_file(bucket, str(first))
+    name = hashlib.md5(b'same content').hexdigest() + '.tif'
+    assert url == 'gs://bucket/' + name
+    assert stage_file(bucket, str(second)) == url
+    assert bucket.uploads == [name]
+
+
+def test_stage_file_replaces_object_with_other_checksums(tmpdir):
+    bucket = FakeBucket()
+    path = tmpdir.join('a.tif')
+    path.write_binary(b'content')
+    name = hashlib.md5(b'content').hexdigest() + '.tif'
+    corrupt = FakeBlob(bucket, name)
+    corrupt.data = b'truncated'
+    corrupt.crc32c = b64(google_crc32c.Checksum(b'truncated').digest())
+    bucket.blobs[name] = corrupt
+
+    stage_file(bucket, str(path))
+    assert bucket.uploads == [name]
+    assert bucket.blobs[name].data == b'content'
+
+
+def test_stage_file_composes_large_files_from_parts(tmpdir):
+    bucket = FakeBucket()
+    content = bytes(range(256)) * 1000
+    path = tmpdir.join('large.tif')
+    path.write_binary(content)
+
+    url = stage_file(bucket, str(path), composite_threshold=1000, composite_workers=4)
+    name = hashlib.md5(content).hexdigest() + '.tif'
+    assert url == 'gs://bucket/' + name
+    assert list(bucket.blobs) == [name]
+    assert bucket.blobs[name].data == content
+    assert len(bucket.uploads) > 1
+
+
+def test_bucket_cache_looks_up_each_bucket_once():
+    lookups = []
+
+    class Client(object):
+        def get_bucket(self, name):
+            lookups.append(name)
+            return FakeBucket(name)
+
+    buckets = BucketCache(Client())
+    assert buckets.get('a') is buckets.get('a')
+    buckets.get('b')
+    assert lookups == ['a', 'b']
+
+
+def test_pooled_adapter_is_sized_to_workers():
+    session = mount_pooled_adapter(requests.Session(), pool_size=16)
+    assert session.get_adapter('https://storage.googleapis.com')._pool_maxsize == 16
+    assert session.get_adapter('http://example.com')._pool_maxsize == 16
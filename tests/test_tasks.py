@@ -0,0 +1,166 @@
+import threading
+
+import ee
+import pytest
+
+from gee_asset_manager.journal import UploadJournal
+from gee_asset_manager.tasks import (BatchStatistics, TaskCache, TaskIdAllocator, TaskScheduler, _percentiles,
+                                     select_tasks)
+
+
+@pytest.fixture
+def statuses(monkeypatch):
+    """Task states returned by the stubbed ee.data.getTaskStatus, by task ID."""
+    states = {}
+    monkeypatch.setattr(ee.data, 'getTaskStatus',
+                        lambda task_ids: [{'id': task_id, 'state': states.get(task_id, 'UNKNOWN')}
+                                          for task_id in task_ids])
+    return states
+
+
+def make_scheduler(**kwargs):
+    # Long intervals keep the background thread out of the way; the tests poll themselves.
+    return TaskScheduler(min_interval=60, max_interval=60, waiting_interval=60, **kwargs)
+
+
+def test_slots_are_counted_from_acquire_to_finish(statuses):
+    completed = []
+    scheduler = make_scheduler(max_active_tasks=2, on_completed=lambda task_id, payload: completed.append(payload))
+    scheduler.acquire()
+    scheduler.acquire()
+    assert scheduler.free_slots == 0
+    scheduler.release()
+    assert scheduler.free_slots == 1
+    scheduler.submitted('a', payload='image a')
+    assert scheduler.free_slots == 1
+
+    statuses['a'] = 'RUNNING'
+    assert scheduler.poll() == 0
+    assert scheduler.free_slots == 1
+    statuses['a'] = 'COMPLETED'
+    assert scheduler.poll() == 1
+    assert scheduler.free_slots == 2
+    assert completed == ['image a']
+    scheduler.close()
+
+
+def test_acquire_waits_until_a_task_finishes(statuses):
+    scheduler = make_scheduler(max_active_tasks=1)
+    scheduler.acquire()
+    scheduler.submitted('a')
+    statuses['a'] = 'READY'
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (scheduler.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.2)
+    statuses['a'] = 'FAILED'
+    scheduler.poll()
+    assert acquired.wait(5)
+    thread.join()
+    scheduler.close()
+
+
+def test_unknown_tasks_are_dropped_after_several_polls(statuses):
+    failed = []
+    scheduler = make_scheduler(max_active_tasks=1, max_unknown_polls=3,
+                               on_failed=lambda task_id, payload, error: failed.append((task_id, error)))
+    scheduler.track('a')
+    assert scheduler.poll() == 0
+    assert scheduler.poll() == 0
+    assert scheduler.free_slots == 0
+    assert scheduler.poll() == 1
+    assert scheduler.free_slots == 1
+    assert failed == [('a', 'UNKNOWN')]
+    scheduler.close()
+
+
+def test_allocator_never_hands_out_an_id_twice(monkeypatch):
+    calls = []
+
+    def new_task_id(count):
+        calls.append(count)
+        if len(calls) == 2:
+            raise ee.EEException('Temporarily unavailable')
+        start = 100 * len(calls)
+        return ['T{}'.format(start + n) for n in range(count)]
+
+    monkeypatch.setattr(ee.data, 'newTaskId', new_task_id)
+    monkeypatch.setattr('time.sleep', lambda seconds: None)
+    allocator = TaskIdAllocator(block_size=3)
+    ids = [allocator.next() for _ in range(7)]
+    assert len(set(ids)) == 7
+    assert calls == [3, 3, 3, 3]
+
+
+def test_select_tasks():
+    tasks = [
+        {'id': 'a', 'state': 'READY', 'task_type': 'INGEST_IMAGE', 'description': 'Asset ingestion: users/a/x',
+         'creation_timestamp_ms': 1000},
+        {'id': 'b', 'state': 'RUNNING', 'task_type': 'INGEST_TABLE', 'description': 'Asset ingestion: users/b/y',
+         'creation_timestamp_ms': 2000},
+        {'id': 'c', 'state': 'READY', 'task_type': 'EXPORT_IMAGE', 'description': 'export',
+         'creation_timestamp_ms': 3000},
+        {'id': 'd', 'state': 'COMPLETED', 'task_type': 'INGEST_IMAGE', 'description': 'Asset ingestion: users/a/z',
+         'creation_timestamp_ms': 4000},
+    ]
+
+    def ids(**kwargs):
+        return [task['id'] for task in select_tasks(tasks, **kwargs)]
+
+    assert ids() == ['a', 'b', 'c']
+    assert ids(states=('READY',)) == ['a', 'c']
+    assert ids(task_types=['INGEST']) == ['a', 'b']
+    assert ids(task_types=['INGEST_TABLE', 'EXPORT']) == ['b', 'c']
+    assert ids(description='*users/a/*') == ['a']
+    assert ids(submitted_after=2000) == ['b', 'c']
+
+
+def test_percentiles():
+    assert _percentiles([]) is None
+    assert _percentiles([7]) == (7, 7, 7)
+    assert _percentiles(list(range(100, 0, -1))) == (50, 95, 99)
+
+
+def ingestion(task_id, state, asset_id, created=None, started=None, updated=None):
+    return {'id': task_id, 'state': state, 'task_type': 'INGEST_IMAGE', 'description': 'Asset ingestion: ' + asset_id,
+            'creation_timestamp_ms': created, 'start_timestamp_ms': started, 'update_timestamp_ms': updated}
+
+
+def test_task_cache_statistics_and_incremental_refresh(monkeypatch, tmpdir):
+    task_list = [
+        ingestion('a1', 'COMPLETED', 'users/a/coll/1', created=0, started=60000, updated=3660000),
+        ingestion('a2', 'COMPLETED', 'users/a/coll/2', created=0, started=120000, updated=7260000),
+        ingestion('a3', 'RUNNING', 'users/a/coll/3', created=0, started=600000),
+        ingestion('a4', 'READY', 'users/a/coll/4', created=1000),
+        {'id': 'e1', 'state': 'FAILED', 'task_type': 'EXPORT_IMAGE', 'description': 'export'},
+    ]
+    monkeypatch.setattr(ee.data, 'getTaskList', lambda: task_list)
+    cache = TaskCache(str(tmpdir.join('tasks.sqlite')))
+    assert cache.refresh() == 5
+    assert cache.statistics() == [
+        BatchStatistics('EXPORT_IMAGE', 0, 0, 0, 1, None, None, None),
+        BatchStatistics('users/a/coll', 1, 1, 2, 0, 1.0, (120.0, 600.0, 600.0), (3600.0, 7140.0, 7140.0)),
+    ]
+
+    journal = UploadJournal(str(tmpdir.join('journal.sqlite')))
+    journal.staged('/data/x.tif', 'users/b/coll/x', 'gs://bucket/x')
+    journal.submitted('/data/x.tif', 'users/b/coll/x', 'j1')
+    journal.close()
+    polled = []
+
+    def get_task_status(task_ids):
+        polled.extend(task_ids)
+        states = {'a3': 'COMPLETED', 'a4': 'RUNNING', 'j1': 'READY'}
+        # Statuses lack the timestamps the task list had.
+        return [{'id': task_id, 'state': states[task_id]} for task_id in task_ids]
+
+    monkeypatch.setattr(ee.data, 'getTaskStatus', get_task_status)
+    assert cache.refresh(journal_paths=[str(tmpdir.join('journal.sqlite'))]) == 3
+    # Only unfinished tasks and new tasks of the journal are asked for.
+    assert sorted(polled) == ['a3', 'a4', 'j1']
+    statistics = {batch.batch: batch for batch in cache.statistics()}
+    assert statistics['users/a/coll'][1:5] == (0, 1, 3, 0)
+    assert statistics['users/a/coll'].queue_latency == (120.0, 600.0, 600.0)
+    assert statistics['users/b/coll'][1:5] == (1, 0, 0, 0)
+    cache.close()